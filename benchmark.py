@@ -0,0 +1,293 @@
+#!/usr/bin/env python
+
+"""Benchmarks for the ranking and seeding hot paths.
+
+Every case runs on synthetic tournaments (see synthetic.py) at each of the
+requested sizes and reports the best and median wall time over a number of
+repeats, the memory taken by its fixtures and the peak memory the timed runs
+needed on top of them. Cases run in a forked process each so the peak memory
+of one does not hide the next one.
+
+The peak is measured by resetting the high-water mark of the resident set
+once the fixtures are built (/proc/self/clear_refs, Linux only). Elsewhere
+only the growth above the high-water mark left by building the fixtures can
+be seen, and those results are marked with "peak_exact": false.
+
+The results are written to benchmarks/results-<revision>.json by default so
+two revisions can be compared with --compare.
+
+Cases:
+    standings   ranking.get_player_standings for each bracket format
+    season      ranking.rank_tournaments plus the head-to-head index over a batch of tournaments
+    rank        the !rank command against a Hypest database, with a cold and a warm cache
+    seeding     seeding.plan with a few late check ins and with a shuffled seeding
+
+Examples:
+    python benchmark.py
+    python benchmark.py --sizes 8,64 --only seeding,rank --repeat 20
+    python benchmark.py --compare benchmarks/results-1a2b3c4.json
+"""
+
+import argparse
+import cPickle
+import gc
+import json
+import multiprocessing
+import os
+import re
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+import irc
+import commands
+import headtohead
+import ranking
+import seeding
+import synthetic
+
+# tournaments per !season rank batch
+season_batch = 4
+
+def memory_status(field):
+    """Returns a field of /proc/self/status (e.g. VmRSS) in KB or None where there is no /proc"""
+    try:
+        with open('/proc/self/status') as f:
+            match = re.search(field + r':\s+(\d+) kB', f.read())
+    except (IOError, OSError):
+        return None
+    return int(match.group(1)) if match else None
+
+def peak_memory():
+    """Returns the peak resident set size of this process in KB"""
+    peak = memory_status('VmHWM')
+    if peak is not None:
+        return peak
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # linux reports KB, os x reports bytes
+    return peak // 1024 if sys.platform == 'darwin' else peak
+
+def current_memory():
+    """Returns the resident set size of this process in KB (the peak where it is unknown)"""
+    current = memory_status('VmRSS')
+    return current if current is not None else peak_memory()
+
+def reset_peak_memory():
+    """Lowers the peak resident set size to the current one, returns False where that is not supported"""
+    gc.collect()
+    try:
+        with open('/proc/self/clear_refs', 'w') as f:
+            f.write('5')
+    except (IOError, OSError):
+        return False
+    return True
+
+def measure(function, repeat, reset=None):
+    """Calls function repeat times and returns (min ms, median ms, peak KB above the current memory, exact peak)
+
+       reset is called before every call and is not timed."""
+    exact = reset_peak_memory()
+    baseline = current_memory() if exact else peak_memory()
+    times = []
+    for _ in range(repeat):
+        if reset is not None:
+            reset()
+        start = time.time()
+        function()
+        times.append((time.time() - start) * 1000.0)
+    times.sort()
+    return times[0], times[len(times) // 2], peak_memory() - baseline, exact
+
+# every case has a fixtures(size, variant) function returning what the timed
+# runs need and a bench(fixtures, repeat, variant) function returning measure()
+
+def standings_fixtures(size, variant):
+    return synthetic.generate_tournament(size, variant, tie_rate=0.05, dq_rate=0.02)
+
+def bench_standings(tournament, repeat, variant):
+    return measure(lambda: ranking.get_player_standings(tournament), repeat)
+
+def season_fixtures(size, variant):
+    return [('synthetic{}'.format(index), synthetic.generate_tournament(size, synthetic.formats[index % 3], seed=index,
+                                                                        tie_rate=0.05, dq_rate=0.02), None)
+            for index in range(season_batch)]
+
+def bench_season(fetched, repeat, variant):
+    workspace = tempfile.mkdtemp(prefix='hypestbench')
+    cwd = os.getcwd()
+    os.chdir(workspace)
+    index = []
+
+    def reset():
+        for filename in os.listdir(workspace):
+            os.remove(os.path.join(workspace, filename))
+        index[:] = [headtohead.HeadToHead(os.path.join(workspace, 'h2h.json'))]
+
+    def run():
+        ranking.rank_tournaments(fetched, on_tournament=index[0].add_tournament)
+        index[0].save()
+
+    try:
+        return measure(run, repeat, reset)
+    finally:
+        os.chdir(cwd)
+        shutil.rmtree(workspace, ignore_errors=True)
+
+class FakeBot(object):
+    nickname = 'BenchBot'
+
+def rank_fixtures(size, variant):
+    # the database file is written here so that encoding it leaves nothing behind in the measured process
+    workspace = tempfile.mkdtemp(prefix='hypestbench')
+    with open(os.path.join(workspace, 'ssb3ds.json'), 'w') as f:
+        json.dump(synthetic.generate_database(size, ranked=1.0), f)
+    return workspace, size
+
+def bench_rank(fixtures, repeat, variant):
+    workspace, size = fixtures
+    commands.conf['ranking_directory'] = workspace
+    # a different case than the database to go through the case-insensitive index
+    message = irc.Message(':user!~user@host PRIVMSG #bench :!rank 3ds PLAYER{}'.format(size - 1))
+    context = irc.Context(FakeBot(), message)
+    reset = ranking.database_cache.clear if variant == 'cold' else None
+    try:
+        ranking.database_cache.clear()
+        if variant == 'warm':
+            commands.rank(context)
+        return measure(lambda: commands.rank(context), repeat, reset)
+    finally:
+        shutil.rmtree(workspace, ignore_errors=True)
+
+def seeding_fixtures(size, variant):
+    database = synthetic.generate_database(size)
+    tournament = synthetic.generate_tournament(size)
+    if variant == 'shuffled':
+        tournament = synthetic.checked_in(tournament, database, shuffle=True)
+    else:
+        tournament = synthetic.checked_in(tournament, database, late=max(1, size // 16))
+    banned = ['player{}'.format(index) for index in range(0, size, 50)]
+    return tournament, database, banned
+
+def bench_seeding(fixtures, repeat, variant):
+    tournament, database, banned = fixtures
+    return measure(lambda: seeding.plan(seeding.get_entrants(tournament, database), banned), repeat)
+
+# case -> (fixtures, bench, variants)
+cases = [
+    ('standings', standings_fixtures, bench_standings, synthetic.formats),
+    ('season', season_fixtures, bench_season, ('mixed',)),
+    ('rank', rank_fixtures, bench_rank, ('cold', 'warm')),
+    ('seeding', seeding_fixtures, bench_seeding, ('late', 'shuffled')),
+]
+
+def _build(fixtures, size, variant, filename, results):
+    try:
+        with open(filename, 'wb') as f:
+            cPickle.dump(fixtures(size, variant), f, cPickle.HIGHEST_PROTOCOL)
+        results.put(('ok', None))
+    except Exception as e:
+        results.put(('error', '{}: {}'.format(type(e).__name__, e)))
+
+def _bench(bench, repeat, variant, filename, results):
+    try:
+        gc.collect()
+        before = current_memory()
+        with open(filename, 'rb') as f:
+            fixtures = cPickle.load(f)
+        gc.collect()
+        loaded = current_memory()
+        results.put(('ok', bench(fixtures, repeat, variant) + (loaded - before,)))
+    except Exception as e:
+        results.put(('error', '{}: {}'.format(type(e).__name__, e)))
+
+def _run(target, *args):
+    results = multiprocessing.Queue()
+    process = multiprocessing.Process(target=target, args=args + (results,))
+    process.start()
+    status, value = results.get()
+    process.join()
+    if status != 'ok':
+        raise RuntimeError(value)
+    return value
+
+def run_case(fixtures, bench, size, repeat, variant):
+    """Runs one benchmark and returns its measure() tuple followed by the KB taken by the fixtures
+
+       The fixtures are built in one forked process and benchmarked in another,
+       so the garbage left by building them is not reused by the timed runs
+       where it would hide their memory."""
+    handle, filename = tempfile.mkstemp(prefix='hypestbench', suffix='.pickle')
+    os.close(handle)
+    try:
+        _run(_build, fixtures, size, variant, filename)
+        return _run(_bench, bench, repeat, variant, filename)
+    finally:
+        os.remove(filename)
+
+def revision():
+    try:
+        output = subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'], stderr=open(os.devnull, 'w'))
+        return output.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return 'unknown'
+
+def key(result):
+    return (result['case'], result['variant'], result['size'])
+
+def compare(results, filename):
+    """Prints the ratio of every result to the same benchmark in an older results file"""
+    with open(filename) as f:
+        old = json.load(f)
+    previous = dict((key(result), result) for result in old['results'])
+    print('compared to {} ({})'.format(old.get('revision', '?'), filename))
+    for result in results:
+        before = previous.get(key(result))
+        if before is None:
+            continue
+        ratio = result['median_ms'] / before['median_ms'] if before['median_ms'] else float('inf')
+        print('{:<10} {:<20} {:>5}  {:8.2f}ms -> {:8.2f}ms  x{:.2f}  memory {:+d}KB'.format(
+            result['case'], result['variant'], result['size'], before['median_ms'], result['median_ms'],
+            ratio, result['peak_kb'] - before['peak_kb']))
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmarks for the HypestBot ranking and seeding code')
+    parser.add_argument('--sizes', default='8,64,512,4096', help='comma separated numbers of entrants')
+    parser.add_argument('--repeat', type=int, default=5, help='timed runs per benchmark')
+    parser.add_argument('--only', default='', help='comma separated cases to run ({})'.format(', '.join(c[0] for c in cases)))
+    parser.add_argument('--output', help='results file (default benchmarks/results-<revision>.json)')
+    parser.add_argument('--compare', help='an older results file to compare against')
+    args = parser.parse_args()
+
+    sizes = [int(size) for size in args.sizes.split(',')]
+    only = set(name for name in args.only.split(',') if name)
+    rev = revision()
+    results = []
+    for name, fixtures_function, bench, variants in cases:
+        if only and name not in only:
+            continue
+        for variant in variants:
+            for size in sizes:
+                best, median, peak, exact, fixtures = run_case(fixtures_function, bench, size, args.repeat, variant)
+                result = {'case': name, 'variant': variant, 'size': size, 'min_ms': round(best, 3),
+                          'median_ms': round(median, 3), 'peak_kb': peak, 'peak_exact': exact, 'fixtures_kb': fixtures}
+                results.append(result)
+                print('{:<10} {:<20} {:>5}  min {:8.2f}ms  median {:8.2f}ms  peak +{}KB{}  fixtures {}KB'.format(
+                    name, variant, size, best, median, peak, '' if exact else ' (above fixtures)', fixtures))
+
+    output = args.output or os.path.join('benchmarks', 'results-{}.json'.format(rev))
+    directory = os.path.dirname(output)
+    if directory and not os.path.isdir(directory):
+        os.makedirs(directory)
+    with open(output, 'w') as f:
+        json.dump({'revision': rev, 'created': time.strftime('%Y-%m-%d %H:%M:%S'), 'python': sys.version.split()[0],
+                   'repeat': args.repeat, 'results': results}, f, sort_keys=True, indent=4)
+    print('results written to {}'.format(output))
+
+    if args.compare:
+        compare(results, args.compare)
+
+if __name__ == '__main__':
+    main()
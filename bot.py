@@ -1,21 +1,45 @@
+import time
+start_time = time.time()
+
 import commands
 import irc
+import log
+import plugins
+import snapshot
 import sys
 
+loader = plugins.PluginLoader()
+
 @commands.owners_only
-@commands.help_text('Reloads the bot\'s internal functions and config file')
+@commands.help_text('Reloads the bot\'s changed internal functions and config file')
 def refresh(bot):
-    reload(commands)
-    reload(irc)
+    start = time.time()
+    changed = loader.reload_changed()
+    if 'irc' in changed:
+        # keep the connection, channels and timers but pick up the new methods
+        bot.__class__ = irc.Bot
     commands.conf = commands.load_config()
-    commands.register(bot)
-    return irc.Response('Bot successfully refreshed internal functions', pm_user=True)
+    log.setup(commands.conf)
+    loader.register(bot)
+    elapsed = (time.time() - start) * 1000.0
+    reloaded = ', '.join(changed) if changed else 'nothing changed'
+    return irc.Response('Bot successfully refreshed ({}) in {:.1f}ms'.format(reloaded, elapsed), pm_user=True)
 
 if __name__ == '__main__':
     commands.conf = commands.load_config()
+    log.setup(commands.conf)
     reload(sys)
     sys.setdefaultencoding('utf-8')
-    bot = irc.Bot(**commands.conf)
+    loader.modules = commands.conf.get('plugins', loader.modules)
+    bot = irc.Bot(start_time=start_time, **commands.conf)
     bot.add_command(refresh)
-    commands.register(bot)
-    bot.run()
+    loader.register(bot)
+    snapshot_file = commands.conf.get('snapshot_file', 'snapshot.pickle')
+    snapshot.restore(bot, snapshot_file)
+    snapshotter = snapshot.Snapshotter(snapshot_file, commands.conf.get('snapshot_interval', 300))
+    snapshotter.start()
+    try:
+        bot.run()
+    finally:
+        snapshotter.stop()
+        log.shutdown()
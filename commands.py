@@ -2,22 +2,45 @@
 
 import irc
 import json
-import urllib
-import csv
 import re, os, sys
 import time
-import codecs
 import datetime as dt
-import shlex
-import requests
 from collections import namedtuple
 from functools import wraps
-import ranking as seasonal
 import threading
 
+# heavier modules (requests, csv, shlex, urllib and ranking) are imported
+# inside the commands that need them so that startup only pays for what is used
+
 # global configuration
 conf = {}
 
+# these are kept across reload() so that !refresh does not lose them
+try:
+    ban_cache
+except NameError:
+    # the parsed bans.txt as (mtime, list of (challonge, end, reason) tuples), plain
+    # tuples since Ban is redefined on every reload and the cache is pickled by snapshot.py
+    ban_cache = {}
+
+try:
+    pending_timers
+except NameError:
+    # (deadline, channel, user) -> threading.Timer for the running !timer commands
+    pending_timers = {}
+
+# commands of different channels run concurrently (see irc.ShardedExecutor) so
+# the commands that rewrite a shared file hold its lock while doing so
+try:
+    config_lock
+except NameError:
+    # !change and !owners, around changing conf and writing config.json
+    config_lock = threading.Lock()
+    # !banish, !unbanish and the pruning done by !prepare
+    bans_lock = threading.Lock()
+    # !season rank and !season reset, around the ranking files, season.txt and the h2h index
+    season_lock = threading.Lock()
+
 def load_config():
     with open('config.json', 'r') as f:
         return json.load(f)
@@ -26,11 +49,28 @@ def update_config(conf):
     with open('config.json', 'wb') as out:
         json.dump(conf, out, sort_keys=True, indent=4, separators=(',', ': '))
 
+def is_owner(bot):
+    """Checks if the sender of the current message is an owner
+
+       When the server provides services accounts the account is checked,
+       otherwise the nick is. With account-tag a message without an account
+       tag comes from someone not logged in. Without it the account tracked
+       from extended-join and account-notify is used, which account-notify
+       keeps up to date when the user logs out."""
+    owners = conf.get('owners', [])
+    capabilities = getattr(bot, 'capabilities', {})
+    if 'account-tag' in capabilities:
+        return bot.message.account is not None and bot.message.account in owners
+    if 'account-notify' in capabilities:
+        account = bot.state.account(bot.message.nick)
+        return account is not None and account in owners
+    return bot.message.nick in owners
+
 def owners_only(command):
     """A decorator to make a command owner-only"""
     @wraps(command)
     def wrapped_up(bot):
-        if bot.message.nick not in conf.get('owners', []):
+        if not is_owner(bot):
             return irc.Response('Sorry, you are not an owner thus not authorised to use this command', pm_user=True)
         return command(bot)
     wrapped_up.owner_only = True
@@ -54,24 +94,29 @@ def help_text(main=None, **text):
 
     main_is_verbose = isinstance(main, tuple) or isinstance(main, list)
     def actual_decorator(command):
+        # the help output never changes so it is rendered once here
+        command_text = irc.command_prefix + command.__name__.lower()
+        format_string = command_text + ' {subcommand} -- {help}'
+        verbose_format = command_text + ' {subcommand} {help[0]} -- {help[1]}'
+        lines = []
+        if main:
+            if main_is_verbose:
+                lines.append('{0} {1[0]} -- {1[1]}'.format(command_text, main))
+            else:
+                lines.append('{} -- {}'.format(command_text, main))
+        lines.append(format_string.format(subcommand='help', help='shows this message'))
+        for subcommand in sorted(text):
+            value = text[subcommand]
+            temp = format_string
+            if isinstance(value, tuple) or isinstance(value, list):
+                temp = verbose_format
+            lines.append(temp.format(subcommand=subcommand, help=value))
+        rendered = irc.Response('\n'.join(lines), pm_user=True)
+
         @wraps(command)
         def wrapper(bot):
             if len(bot.message.words) >= 2 and bot.message.words[1] == 'help':
-                command_text = irc.command_prefix + command.__name__.lower()
-                format_string = command_text + ' {subcommand} -- {help}'
-                verbose_format = command_text + ' {subcommand} {help[0]} -- {help[1]}'
-                if main:
-                    if main_is_verbose:
-                        bot.send_message(bot.message.nick, '{0} {1[0]} -- {1[1]}'.format(command_text, main))
-                    else:
-                        bot.send_message(bot.message.nick, ('{} -- {}'.format(command_text, main)))
-                bot.send_message(bot.message.nick, format_string.format(subcommand='help', help='shows this message'))
-                for subcommand in text:
-                    value = text[subcommand]
-                    temp = format_string
-                    if isinstance(value, tuple) or isinstance(value, list):
-                        temp = verbose_format
-                    bot.send_message(bot.message.nick, temp.format(subcommand=subcommand, help=value))
+                return rendered
             else:
                 return command(bot)
 
@@ -107,21 +152,59 @@ def requirements(length=2, subcommands=None):
         return wrapper
     return actual_decorator
 
-@help_text('shows a list of commands')
+"""The pre-rendered, paginated output of botcommands
+
+Two views are rendered, one for owners and one for everyone else. The
+catalog is stored on the bot and thrown away by irc.Bot.add_command whenever
+the registry changes, so it is only rebuilt after (re)registration."""
+class HelpCatalog(object):
+    page_size = 10
+
+    def __init__(self, commands):
+        self.pages = {
+            True: self.render(commands, owner=True),
+            False: self.render(commands, owner=False)
+        }
+
+    def render(self, commands, owner):
+        visible = sorted(key for key in commands if owner or not hasattr(commands[key], 'owner_only'))
+        if len(visible) == 0:
+            return [['none found!']]
+
+        offset = len(max(visible, key=len)) + 2
+        lines = []
+        for key in visible:
+            text = commands[key].func_dict.get('help', None)
+            format_string = '{command:<{offset}} -- {help}' if text else '{command:<{offset}}'
+            lines.append(format_string.format(command=key, help=text, offset=offset))
+
+        return [lines[index:index + self.page_size] for index in range(0, len(lines), self.page_size)]
+
+    def page(self, owner, number):
+        """Returns the text of the given 1-based page number or None if it does not exist"""
+        pages = self.pages[owner]
+        if number < 1 or number > len(pages):
+            return None
+        header = 'available commands (page {} of {}):'.format(number, len(pages))
+        if number < len(pages):
+            header = header[:-1] + ', see {}botcommands {} for more:'.format(irc.command_prefix, number + 1)
+        return '\n'.join([header] + pages[number - 1])
+
+@help_text(main=('[page]', 'shows a list of commands'))
 def botcommands(bot):
-    bot.send_message(bot.message.nick, 'available commands:\n')
-    is_owner = bot.message.nick in conf.get('owners', [])
-    offset = len(max(bot.commands, key=lambda k: len(k))) + 2
-    for key in bot.commands:
-        command = bot.commands[key]
-        is_owner_only = hasattr(command, 'owner_only')
-        text = command.func_dict.get('help', None)
-        format_string = '{command:<{offset}} -- {help}' if text else '{command:<{offset}}'
-        if not is_owner and is_owner_only:
-            continue
-        bot.send_message(bot.message.nick, format_string.format(command=key, help=text, offset=offset))
-    if len(bot.commands) == 0:
-        bot.send_message(bot.message.nick, 'none found!')
+    catalog = getattr(bot, 'help_catalog', None)
+    if catalog is None:
+        catalog = bot.help_catalog = HelpCatalog(bot.commands)
+
+    try:
+        number = int(bot.message.words[1]) if len(bot.message.words) >= 2 else 1
+    except ValueError:
+        return irc.Response('The page must be a number', pm_user=True)
+
+    text = catalog.page(is_owner(bot), number)
+    if text is None:
+        return irc.Response('There is no page {} of commands'.format(number), pm_user=True)
+    return irc.Response(text, pm_user=True)
 
 @owners_only
 @help_text('leaves the current channel')
@@ -170,15 +253,16 @@ def change(bot):
     if not channel.startswith('#'):
         return irc.Response('This command must be used outside of private messages', pm_user=True)
 
-    info = conf.get(command, None)
-    if info == None:
-        info = { channel: bot.message.words[2] }
-    elif isinstance(info, dict):
-        info[channel] = bot.message.words[2]
-    else:
-        return irc.Response('Unable to update {} due to invalid configuration type'.format(command))
-    conf[command] = info
-    update_config(conf)
+    with config_lock:
+        info = conf.get(command, None)
+        if info == None:
+            info = { channel: bot.message.words[2] }
+        elif isinstance(info, dict):
+            info[channel] = bot.message.words[2]
+        else:
+            return irc.Response('Unable to update {} due to invalid configuration type'.format(command))
+        conf[command] = info
+        update_config(conf)
     return irc.Response('Successfully updated', pm_user=True)
 
 @owners_only
@@ -196,15 +280,16 @@ def owners(bot):
         return irc.Response('Invalid command given ({}) check !owners help'.format(command), pm_user=True)
 
     owner = bot.message.words[2]
-    if command == 'add':
-        list_of_owners.append(owner)
-    elif command == 'remove':
-        if owner not in list_of_owners:
-            return irc.Response('Owner "{}" not found (note this is case sensitive)'.format(owner), pm_user=True)
-        list_of_owners.remove(owner)
-
-    conf['owners'] = list_of_owners
-    update_config(conf)
+    with config_lock:
+        if command == 'add':
+            list_of_owners.append(owner)
+        elif command == 'remove':
+            if owner not in list_of_owners:
+                return irc.Response('Owner "{}" not found (note this is case sensitive)'.format(owner), pm_user=True)
+            list_of_owners.remove(owner)
+
+        conf['owners'] = list_of_owners
+        update_config(conf)
     return irc.Response('Successfully updated', pm_user=True)
 
 @help_text('accesses ranking information for different games',**{
@@ -218,6 +303,7 @@ def owners(bot):
            })
 @requirements(length=3, subcommands=['3ds', 'melee', 'wiiu', 'brawl', 'ssf2', '64', 'projectm'])
 def rank(bot):
+    import ranking as seasonal
     directory = conf.get('ranking_directory', None)
     if directory == None or not os.path.exists(directory):
         return irc.Response('Internal error occurred: no directory for databases', pm_user=True)
@@ -233,13 +319,8 @@ def rank(bot):
     if not os.path.exists(full_filename):
         return irc.Response('Internal error occurred: no database file found', pm_user=True)
 
-    db = {}
-    with open(full_filename, 'r') as f:
-        db = json.loads(f.read().decode('utf-8-sig'))
-
-    db = dict((k.lower(), v) for k, v in db.iteritems())
-
-    entry = db.get(words[2].lower(), None)
+    db = seasonal.load_database(full_filename)
+    entry = db.lookup(words[2])
     if entry == None:
         return irc.Response('No entry found for ' + words[2], pm_user=True)
 
@@ -248,23 +329,20 @@ def rank(bot):
         if key not in entry:
             return irc.Response('Internal error: incomplete entry found for ' + words[2], pm_user=True)
 
-    # create the rankings list
-    ranking = sorted(db.values(), key=lambda e: e['rating'], reverse=True)
-    ranking = [x['challonge_username'] for x in ranking]
     # check the player placing
     stats = 'Rating: {0} (Wins: {1}, Losses: {2}, Ties: {3}) [W/L Ratio: {4:.2}]'
     ratio = float(entry['wins']) if entry['losses'] == 0 else float(entry['wins'])/entry['losses']
     stats = stats.format(entry['rating'], entry['wins'], entry['losses'], entry['ties'], ratio)
 
-    try:
-        place = ranking.index(entry['challonge_username'])
-        placing = 'User {2} is ranked {0} out of {1} players.\n'.format(place + 1, len(ranking), entry['challonge_username'])
-        return irc.Response(placing + stats, pm_user=True)
-    except Exception as e:
+    place = db.places.get(entry['challonge_username'], None)
+    if place is None:
         return irc.Response(stats, pm_user=True)
+    placing = 'User {2} is ranked {0} out of {1} players.\n'.format(place + 1, db.size, entry['challonge_username'])
+    return irc.Response(placing + stats, pm_user=True)
 
 @help_text('lists current streams using the pastebin URL')
 def streams(bot):
+    import urllib, csv
     result = []
     pastebin = "http://pastebin.com/raw.php?i=x5qCS5Gz"
     data = urllib.urlopen(pastebin)
@@ -279,11 +357,55 @@ def streams(bot):
 
     return irc.Response('\n'.join(result))
 
+Ban = namedtuple('Ban', ['challonge', 'end', 'reason'])
+
+def read_bans():
+    """Returns every Ban in bans.txt, cached until the file changes"""
+    import shlex
+    if not os.path.exists('bans.txt'):
+        return []
+
+    mtime = os.path.getmtime('bans.txt')
+    cached = ban_cache.get('bans.txt')
+    if cached is None or cached[0] != mtime:
+        bans = []
+        with open('bans.txt') as ban_file:
+            for line in ban_file:
+                parts = shlex.split(line)
+                bans.append((parts[0], dt.datetime.strptime(parts[1], '%B %d, %Y').date(), parts[2]))
+        cached = ban_cache['bans.txt'] = (mtime, bans)
+    return [Ban(*ban) for ban in cached[1]]
+
+def active_bans(prune=True):
+    """Returns the set of currently banned challonge usernames
+
+       Unless prune is False, expired bans are removed from bans.txt as a side effect."""
+    today = dt.date.today()
+    if not prune:
+        return set(ban.challonge for ban in read_bans() if ban.end > today)
+
+    # a !banish in another channel must not land between the read and the rewrite
+    with bans_lock:
+        all_bans = read_bans()
+        bans = [ban for ban in all_bans if ban.end > today]
+
+        # update the bans.txt file with the list of currently banned users
+        # effectively removing the now unbanned users
+        if len(all_bans) != len(bans):
+            with open('bans.txt', 'w') as f:
+                for ban in bans:
+                    f.write('{} "{}" "{}"\n'.format(ban.challonge, ban.end.strftime('%B %d, %Y'), ban.reason))
+
+    return set(ban.challonge for ban in bans)
+
 # prepares the bracket by seeding and removing banned players
 @owners_only
-@help_text('prepares the bracket by seeding and removing banned users')
+@help_text(main=('<url> [dry]', 'prepares the bracket by seeding and removing banned users, dry only shows the plan'))
 @requirements(length=2)
 def prepare(bot):
+    import requests
+    import ranking as seasonal
+    import seeding
     directory = conf.get('ranking_directory', None)
     if directory == None or not os.path.exists(directory):
         return irc.Response('No ranking database has been found. Sorry.', pm_user=True)
@@ -296,104 +418,67 @@ def prepare(bot):
     url = m.group('url')
     if m.group('subdomain'):
         url = '{}-{}'.format(m.group('subdomain'), m.group('url'))
+    dry_run = len(bot.message.words) >= 3 and bot.message.words[2].lower() == 'dry'
 
-
-    params = {
-        'api_key': api_key,
-        'include_participants': '1'
-    }
-
-    participants = requests.get('https://api.challonge.com/v1/tournaments/{}.json'.format(url), params=params)
-    if participants.status_code != 200:
-        return irc.Response('Unable to access challonge API [error: {}]'.format(participants.text), pm_user=True)
-    js = participants.json()
-
-    tournament = js['tournament']
+    try:
+        challonge = seasonal.Challonge(api_key)
+        if dry_run:
+            # repeated dry runs reuse the payload, the real run always plans from fresh check ins
+            tournament = challonge.cached_tournament(url, conf.get('tournament_cache_seconds', 60))
+        else:
+            tournament = challonge.show_tournament(url, include_matches=False)
+    except seasonal.ChallongeAPIError as e:
+        return irc.Response('Unable to access challonge API [error: {}]'.format(e), pm_user=True)
 
     if tournament['state'] == 'complete':
         return irc.Response('Tournament is already complete', pm_user=True)
     elif tournament['state'] != 'checked_in':
         return irc.Response('Check ins have not been processed yet', pm_user=True)
 
-    full_filename = os.path.join(directory, seasonal.game_to_filename.get(tournament['game_id'], None))
+    filename = seasonal.game_to_filename.get(tournament['game_id'], None)
+    full_filename = os.path.join(directory, filename) if filename else None
     if full_filename == None or not os.path.exists(full_filename):
         return irc.Response('Hypest Database file not found', pm_user=True)
 
-    db = {}
-    with open(full_filename) as f:
-        db = json.loads(f.read().decode('utf-8-sig'))
-
-    # get a mapping of (challonge_username, participant_id, rating)
-    User = namedtuple('User', ['name', 'id', 'rating'])
-    users = []
-    for obj in tournament['participants']:
-        participant = obj['participant']
-        if participant.get('checked_in', False):
-            name = participant["challonge_username"]
-            pid = participant["id"]
-            rating = db.get(name, None)
-            if rating == None:
-                users.append(User(name=name, id=pid, rating=0))
-            else:
-                users.append(User(name=name, id=pid, rating=rating['rating']))
-
-
-    # sort the users by their rating score
-    users.sort(key=lambda x: x.rating, reverse=True)
-
-    # just stores the banned usernames for quick lookup
-    banned_usernames = []
-
-    if os.path.exists('bans.txt'):
-        # obtain the list of banned users
-        Ban = namedtuple('Ban', ['challonge', 'end', 'reason'])
-        bans = []
-        old_ban_lines = 0
-        with open('bans.txt') as ban_file:
-            today = dt.date.today()
-            for line in ban_file:
-                old_ban_lines += 1
-                parts = shlex.split(line)
-                ban = Ban(challonge=parts[0], end=dt.datetime.strptime(parts[1], '%B %d, %Y').date(), reason=parts[2])
-                if ban.end > today:
-                    bans.append(ban)
+    db = seasonal.load_database(full_filename)
+    users = seeding.get_entrants(tournament, db.entries)
+    # a dry run has no side effects, not even pruning bans.txt
+    plan = seeding.plan(users, active_bans(prune=not dry_run))
 
+    if dry_run:
+        result = [ 'Dry run: {} API calls needed ({} seeds already in place)'.format(plan.api_calls(), plan.unchanged) ]
+        result.extend(plan.describe())
+        return irc.Response('\n'.join(result), pm_user=True)
 
-        # update the bans.txt file with the list of currently banned users
-        # effectively removing the now unbanned users
-        if old_ban_lines != len(bans):
-            with open('bans.txt', 'w') as f:
-                for ban in bans:
-                    f.write('{} "{}" "{}"\n'.format(ban.challonge, ban.end.strftime('%B %d, %Y'), ban.reason))
-                    banned_usernames.append(ban.challonge)
+    params = {
+        'api_key': api_key
+    }
+    participant_url = '{}/tournaments/{}/participants/{{}}.json'.format(seasonal.Challonge.API_BASE_URL, url)
 
-    # update the seed based on position on the list
-    # the seeds.txt file is used as a way to debug if something goes wrong in the future
-    f = open('seeds.txt', 'w')
-    seed = 1
-    removed_users = []
-    for user in users:
-        params = {
-            'api_key': api_key
-        }
+    try:
+        for user in plan.removals:
+            r = requests.delete(participant_url.format(user.id), params=params)
+            if r.status_code != 200:
+                return irc.Response('Unable to access challonge API [error: {}]'.format(r.text), pm_user=True)
 
-        # check if a user is banned, and if so remove them from the seeding calculation
-        if user.name in banned_usernames:
-            removed_users.append(user.name)
-            r = requests.delete('https://api.challonge.com/v1/tournaments/{}/participants/{}.json'.format(url, user.id), params=params)
+        for user, seed in plan.moves:
+            params['participant[seed]'] = seed
+            r = requests.put(participant_url.format(user.id), params=params)
             if r.status_code != 200:
                 return irc.Response('Unable to access challonge API [error: {}]'.format(r.text), pm_user=True)
-            continue
+    finally:
+        # the next dry run must not preview from the participants before these writes
+        seasonal.tournament_cache.pop(url, None)
 
-        f.write('{} has a seed of {}\n'.format(str(user), seed))
-        params['participant[seed]'] = seed
-        r = requests.put('https://api.challonge.com/v1/tournaments/{}/participants/{}.json'.format(url, user.id), params=params)
-        if r.status_code != 200:
-            return irc.Response('Unable to access challonge API [error: {}]'.format(r.text), pm_user=True)
-        seed += 1
+    # the seeds.txt file is used as a way to debug if something goes wrong in the future
+    with open('seeds.txt', 'a') as f:
+        f.write('# {} {} ({} API calls)\n'.format(dt.datetime.now().isoformat(), url, plan.api_calls()))
+        for seed, user in enumerate(plan.target, 1):
+            f.write('{} has a seed of {}\n'.format(str(user), seed))
 
     # prepare statistics
-    result = [ 'Tournament has successfully been prepared' ]
+    removed_users = [user.name for user in plan.removals]
+    result = [ 'Tournament has successfully been prepared ({} API calls)'.format(plan.api_calls()) ]
     newcomers = sum(1 for user in users if user.rating == 0)
     result.append('Total number of participants: {}'.format(len(users)))
     result.append('Newcomers joined: {}'.format(newcomers))
@@ -408,6 +493,7 @@ def prepare(bot):
 @help_text(main=('<username> <days> [reason]', 'bans players from participating in our tournaments'))
 @requirements(length=3)
 def banish(bot):
+    import shlex
     if bot.message.text.strip() == '!banish':
         with open('bans.txt') as f:
             result = []
@@ -417,10 +503,11 @@ def banish(bot):
             return irc.Response('\n'.join(result), pm_user=True)
 
     words = bot.message.text.split(' ')
-    with open('bans.txt', 'a') as f:
-        end_date = dt.date.today() + dt.timedelta(days=int(words[2]))
-        reason = ' '.join(words[3:])
-        f.write('{} "{}" "{}"\n'.format(words[1], end_date.strftime('%B %d, %Y'), reason))
+    end_date = dt.date.today() + dt.timedelta(days=int(words[2]))
+    reason = ' '.join(words[3:])
+    with bans_lock:
+        with open('bans.txt', 'a') as f:
+            f.write('{} "{}" "{}"\n'.format(words[1], end_date.strftime('%B %d, %Y'), reason))
 
     return irc.Response('User {} successfully banished for {} days'.format(words[1], words[2]), pm_user=True)
 
@@ -433,11 +520,12 @@ def unbanish(bot):
         return irc.Response('Incorrect format. Check !unbanish help for more info', pm_user=True)
 
     bans = ''
-    with open('bans.txt') as f:
-        bans = filter(lambda x: words[1] not in x, f.readlines())
+    with bans_lock:
+        with open('bans.txt') as f:
+            bans = filter(lambda x: words[1] not in x, f.readlines())
 
-    with open('bans.txt', 'w') as f:
-        f.write(''.join(bans))
+        with open('bans.txt', 'w') as f:
+            f.write(''.join(bans))
 
     return irc.Response('User {} successfully unbanished'.format(words[1]), pm_user=True)
 
@@ -501,32 +589,77 @@ def ranking(bot):
 def calendar(bot):
     return irc.Response("http://www.reddit.com/r/smashbros/wiki/eventcalendar")
 
+def ranked_tournaments():
+    """Returns the tournaments already ranked since the last reset
+
+       They are normalised with Challonge.prepare_url since the same tournament
+       can be written as a full URL or without the scheme."""
+    import ranking as seasonal
+    processed = set()
+    if os.path.exists('season.txt'):
+        with open('season.txt') as f:
+            for line in f:
+                line = line.strip()
+                if line.startswith('---'):
+                    processed = set()
+                elif line:
+                    processed.add(seasonal.Challonge.prepare_url(line))
+    return processed
+
 @owners_only
 def season_rank(bot):
-    """Given a URL, updates the ranking"""
+    """Given URLs or a subdomain:<name> listing, updates the ranking"""
+    import ranking as seasonal
     if len(bot.message.words) < 3:
-        return irc.Response('URL parameter is missing. The proper command is !season rank <url>', pm_user=True)
+        return irc.Response('URL parameter is missing. The proper command is !season rank <url> [url ...]', pm_user=True)
+
+    # message.words strips trailing punctuation which URLs might need
+    arguments = bot.message.text.split()[2:]
+    urls = [url for url in arguments if not url.startswith('subdomain:')]
     try:
-        with open('season.txt', 'a') as f:
-            f.write(bot.message.words[2])
-            f.write('\n')
-        seasonal.update_rankings(bot.message.words[2], conf['challonge'])
-        return irc.Response('Successfully updated the seasonal rankings', pm_user=True)
+        for argument in arguments:
+            if argument.startswith('subdomain:'):
+                processed = ranked_tournaments()
+                challonge = seasonal.Challonge(conf['challonge'])
+                listed = challonge.list_tournaments(argument[len('subdomain:'):])
+                urls.extend(url for url in listed if seasonal.Challonge.prepare_url(url) not in processed)
+
+        if len(urls) == 0:
+            return irc.Response('No new tournaments found to rank', pm_user=True)
+
+        nick = bot.message.nick
+        def report(url, success, status):
+            bot.send_message(nick, '[{}] {}: {}'.format('done' if success else 'failed', url, status))
+
+        import headtohead
+        # another !season rank would add to the same index and ranking files
+        with season_lock:
+            index = headtohead.load(conf.get('h2h_file', 'h2h.json'))
+            statuses = seasonal.update_rankings_many(urls, conf['challonge'], callback=report, on_tournament=index.add_tournament)
+            index.save()
+            ranked = [url for url, success, status in statuses if success]
+            with open('season.txt', 'a') as f:
+                for url in ranked:
+                    f.write(url)
+                    f.write('\n')
+        return irc.Response('Updated the seasonal rankings with {} of {} tournaments'.format(len(ranked), len(statuses)), pm_user=True)
     except Exception as e:
         return irc.Response('An error occurred: ' + str(e), pm_user=True)
 
 @owners_only
 def season_reset(bot):
     """Removes the filename"""
-    with open('ssbwiiu.json', 'w') as f:
-        f.write('{}')
-    with open('season.txt', 'a') as f:
-        f.write('---------\n')
+    with season_lock:
+        with open('ssbwiiu.json', 'w') as f:
+            f.write('{}')
+        with open('season.txt', 'a') as f:
+            f.write('---------\n')
 
     return irc.Response('Seasonal rankings successfully purged', pm_user=True)
 
 def season_check(bot):
     """Checks the challonge username's ranking"""
+    import ranking as seasonal
     if len(bot.message.words) < 3:
         return irc.Response('Challonge username is missing. The proper command is !season check <challonge_username>', pm_user=True)
 
@@ -546,6 +679,7 @@ def season_check(bot):
 
 def season_top(bot):
     """Returns a list of top players"""
+    import ranking as seasonal
     if len(bot.message.words) < 3:
         return irc.Response('Number to cut off is missing. The proper command is !season top <number> [condensed?]', pm_user=True)
 
@@ -564,7 +698,8 @@ def season_top(bot):
         return irc.Response('Number to cut off must be a number.', pm_user=True)
 
 
-@help_text('manages the seasonal playoffs', rank=('<url>', 'updates the seasonal rankings with the given URL'),
+@help_text('manages the seasonal playoffs',
+           rank=('<url> [url ...] | subdomain:<name>', 'updates the seasonal rankings with the given URLs or new tournaments of a subdomain'),
            reset='resets the seasonal rankings', top=('<number> [condensed?]', 'returns the top number of players this season'),
            check=('<challonge_username>', 'checks your seasonal ranking placing'))
 @requirements(length=2, subcommands=['rank', 'check', 'reset', 'top'])
@@ -576,17 +711,108 @@ def season(bot):
 @help_text(main=('<minutes>', 'implements a timer to notify the user'))
 @requirements(length=2)
 def timer(bot):
-    def notify(channel, user):
-        lock = threading.Lock()
-        with lock:
-            bot.send_message(channel, 'Hello {}! Your timer is up!'.format(user))
     try:
         minutes = float(bot.message.words[1])
-        t = threading.Timer(60.0 * minutes, notify, args=[bot.current_channel, bot.message.nick])
-        t.start()
+        schedule_timer(bot, time.time() + 60.0 * minutes, bot.current_channel, bot.message.nick)
     except ValueError as e:
         return irc.Response('You must pass in a number of minutes', pm_user=True)
 
+def schedule_timer(bot, deadline, channel, user):
+    """Notifies the user in the channel at the given time.time() deadline
+
+       The pending timers are recorded in pending_timers so they can be
+       saved in a snapshot and armed again after a restart."""
+    key = (deadline, channel, user)
+    def notify():
+        pending_timers.pop(key, None)
+        bot.send_message(channel, 'Hello {}! Your timer is up!'.format(user))
+    t = threading.Timer(max(0.0, deadline - time.time()), notify)
+    t.daemon = True
+    pending_timers[key] = t
+    t.start()
+
+@help_text(main=('<player> <player>', 'shows the head-to-head record of two players in the ranked tournaments'))
+@requirements(length=3)
+def h2h(bot):
+    import headtohead
+    # the index holds the unicode names decoded from the Challonge JSON
+    words = bot.message.text.decode('utf-8', 'replace').split()
+    index = headtohead.load(conf.get('h2h_file', 'h2h.json'))
+    one, two = index.display_name(words[1]), index.display_name(words[2])
+    record = index.lookup(one, two)
+    if record is None:
+        return irc.Response('{} and {} have not played each other in a ranked tournament'.format(one, two))
+
+    wins, losses, ties, last_played = record
+    text = '{} {} - {} {}'.format(one, wins, losses, two)
+    if ties:
+        text += ' ({} tie{})'.format(ties, 's' if ties > 1 else '')
+    if last_played:
+        text += ', last played {}'.format(last_played[:10])
+    return irc.Response(text)
+
+@help_text(main=('<player>', 'shows the most recent ranked matches of a player'))
+@requirements(length=2)
+def recent(bot):
+    import headtohead
+    # the index holds the unicode names decoded from the Challonge JSON
+    words = bot.message.text.decode('utf-8', 'replace').split()
+    index = headtohead.load(conf.get('h2h_file', 'h2h.json'))
+    matches = index.recent_matches(words[1])
+    if len(matches) == 0:
+        return irc.Response('No ranked matches found for ' + words[1], pm_user=True)
+
+    verbs = { 'win': 'beat', 'loss': 'lost to', 'tie': 'tied with' }
+    lines = []
+    for completed_at, opponent, result, title in matches[:5]:
+        line = '{} {} {}'.format(index.display_name(words[1]), verbs[result], opponent)
+        if title:
+            line += ' at {}'.format(title)
+        if completed_at:
+            line += ' ({})'.format(completed_at[:10])
+        lines.append(line)
+    return irc.Response('\n'.join(lines), pm_user=True)
+
+@owners_only
+@help_text(main=('[sample] <seconds>s | <commands> | stop', 'profiles the bot for some seconds or commands then PMs a summary'))
+@requirements(length=2)
+def profile(bot):
+    import profiler
+    words = bot.message.words[1:]
+    if words[0].lower() == 'stop':
+        if getattr(bot, 'profiler', None) is None:
+            return irc.Response('The bot is not being profiled', pm_user=True)
+        bot.profiler.finish()
+        return
+
+    if getattr(bot, 'profiler', None) is not None:
+        return irc.Response('The bot is already being profiled, use !profile stop first', pm_user=True)
+
+    mode = 'cprofile'
+    if words[0].lower() == 'sample':
+        mode = 'sample'
+        words = words[1:]
+
+    seconds = None
+    commands = None
+    try:
+        if len(words) == 0:
+            seconds = 30.0
+        elif words[0].endswith('s'):
+            seconds = float(words[0][:-1])
+        else:
+            commands = int(words[0])
+    except ValueError:
+        return irc.Response('Expected a number of seconds (e.g. 30s) or commands (e.g. 50). Try !profile help', pm_user=True)
+    if (seconds is not None and not 0 < seconds < float('inf')) or (commands is not None and commands <= 0):
+        return irc.Response('The number of seconds or commands must be positive', pm_user=True)
+
+    p = profiler.Profiler(bot, bot.message.nick, mode=mode, seconds=seconds, commands=commands,
+                          directory=conf.get('profile_directory', 'profiles'))
+    p.start()
+    limit = '{:g} seconds'.format(seconds) if seconds is not None else '{} commands'.format(commands)
+    return irc.Response('Profiling ({}) for the next {}'.format(mode, limit), pm_user=True)
+
 def register(bot):
     bot.add_command(botcommands)
     bot.add_command(quit)
@@ -610,3 +836,6 @@ def register(bot):
     bot.add_command(debug)
     bot.add_command(season)
     bot.add_command(timer)
+    bot.add_command(profile)
+    bot.add_command(h2h)
+    bot.add_command(recent)
@@ -0,0 +1,136 @@
+import json
+import os
+import threading
+
+import ranking
+
+"""A persistent head-to-head index of the ingested matches
+
+For every pair of players it keeps the wins of each side, the ties and the
+date of their last match, and for every player their most recent matches.
+Tournaments are added incrementally as they are ranked (each one only once)
+so the !h2h and !recent commands are answered with dictionary lookups.
+
+The index is stored as JSON:
+    {
+        "tournaments": [ids of the ingested tournaments],
+        "names": {lowercased name: display name},
+        "pairs": [[name a, name b, wins a, wins b, ties, last played], ...],
+        "recent": {lowercased name: [[completed_at, opponent, result, tournament name], ...]}
+    }
+where name a < name b (both lowercased) and result is one of win, loss or tie."""
+
+# number of matches kept per player for !recent
+recent_size = 10
+
+# kept across reload() so that !refresh does not empty the cache or replace the lock
+try:
+    index_cache
+except NameError:
+    # filename -> (mtime, HeadToHead)
+    index_cache = {}
+    # held while an index is written, they all share the same temporary file name
+    save_lock = threading.Lock()
+
+class HeadToHead(object):
+    def __init__(self, filename):
+        self.filename = filename
+        self.tournaments = set()
+        self.names = {}
+        # (name a, name b) -> [wins a, wins b, ties, last played]
+        self.pairs = {}
+        self.recent = {}
+
+    def add_tournament(self, tournament):
+        """Adds the matches of a complete tournament payload, returns False if it was already added"""
+        identifier = tournament.get('id', tournament.get('url'))
+        if identifier in self.tournaments:
+            return False
+        self.tournaments.add(identifier)
+
+        title = tournament.get('name', '')
+        for one, two, winner, completed_at in ranking.get_match_results(tournament):
+            if one is None or two is None:
+                continue
+            self.add_match(one, two, winner, completed_at or '', title)
+        return True
+
+    def add_match(self, one, two, winner, completed_at, title):
+        a, b = one.lower(), two.lower()
+        self.names[a] = one
+        self.names[b] = two
+        key = (a, b) if a < b else (b, a)
+        record = self.pairs.setdefault(key, [0, 0, 0, ''])
+        if winner is None:
+            record[2] += 1
+        elif winner.lower() == key[0]:
+            record[0] += 1
+        else:
+            record[1] += 1
+        record[3] = max(record[3], completed_at)
+
+        for player, opponent in ((one, two), (two, one)):
+            if winner is None:
+                result = 'tie'
+            else:
+                result = 'win' if winner.lower() == player.lower() else 'loss'
+            matches = self.recent.setdefault(player.lower(), [])
+            matches.append([completed_at, opponent, result, title])
+            matches.sort(reverse=True)
+            del matches[recent_size:]
+
+    def lookup(self, one, two):
+        """Returns (wins of one, wins of two, ties, last played) or None if they never played"""
+        a, b = one.lower(), two.lower()
+        if a < b:
+            record = self.pairs.get((a, b))
+            return tuple(record) if record else None
+        record = self.pairs.get((b, a))
+        return (record[1], record[0], record[2], record[3]) if record else None
+
+    def display_name(self, name):
+        return self.names.get(name.lower(), name)
+
+    def recent_matches(self, name):
+        return self.recent.get(name.lower(), [])
+
+    def save(self):
+        data = {
+            'tournaments': sorted(self.tournaments),
+            'names': self.names,
+            'pairs': [[a, b] + record for (a, b), record in self.pairs.iteritems()],
+            'recent': self.recent
+        }
+        temporary = self.filename + '.tmp'
+        with save_lock:
+            with open(temporary, 'w') as f:
+                json.dump(data, f)
+            os.rename(temporary, self.filename)
+            index_cache[self.filename] = (os.path.getmtime(self.filename), self)
+
+# the indexes cached before a reload() use the new class, snapshot.py can't pickle the old one
+for _, cached_index in index_cache.itervalues():
+    cached_index.__class__ = HeadToHead
+
+def load(filename):
+    """Returns the HeadToHead index stored in filename (empty if it does not exist)
+
+       The parsed index is cached until the file changes."""
+    try:
+        mtime = os.path.getmtime(filename)
+    except OSError:
+        mtime = None
+    cached = index_cache.get(filename)
+    if cached is not None and cached[0] == mtime:
+        return cached[1]
+
+    index = HeadToHead(filename)
+    if mtime is not None:
+        with open(filename) as f:
+            data = json.load(f)
+        index.tournaments = set(data.get('tournaments', []))
+        index.names = data.get('names', {})
+        index.pairs = dict(((a, b), record) for a, b, record in ((p[0], p[1], p[2:]) for p in data.get('pairs', [])))
+        index.recent = data.get('recent', {})
+    index_cache[filename] = (mtime, index)
+    return index
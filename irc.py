@@ -1,19 +1,52 @@
 import socket, time
 import re, string
-import traceback
+import base64
+import threading
+import Queue
+import log
+import state
+
+logger = log.get_logger('irc')
 
 command_prefix = '!'
 
+# the IRCv3 capabilities the bot asks for when the server offers them
+wanted_capabilities = ['multi-prefix', 'message-tags', 'batch', 'labeled-response', 'account-tag', 'draft/multiline',
+                       'extended-join', 'account-notify']
+
+tag_escapes = { ':': ';', 's': ' ', '\\': '\\', 'r': '\r', 'n': '\n' }
+
+def parse_tags(raw):
+    """Parses the IRCv3 message tags (without the leading @) into a dictionary"""
+    tags = {}
+    for item in raw.split(';'):
+        if not item:
+            continue
+        key, _, value = item.partition('=')
+        if '\\' in value:
+            value = re.sub(r'\\(.?)', lambda m: tag_escapes.get(m.group(1), m.group(1)), value)
+        tags[key] = value
+    return tags
+
 """
 Represents an IRC message
 """
 class Message(object):
+    # :rapptz!rapptz@user/rapptz/x-00071589 PRIVMSG #SmashBrosTourney :okay sign in seems to be working
+    regex = re.compile(r'(?::(?P<source>(?P<nick>[^!\s]+)!~?(?P<user>[^@\s]+)@)?(?P<host>[^\s]+)\s)?(?P<command>[^\s]+)\s?(?P<parameters>[^:]+)?:?(?P<text>[^\r^\n]+)?')
+
     def __init__(self, msg):
-        # :rapptz!rapptz@user/rapptz/x-00071589 PRIVMSG #SmashBrosTourney :okay sign in seems to be working
-        regex = r':(?P<source>(?P<nick>[^!]+)!~?(?P<user>[^@]+)@)?(?P<host>[^\s]+)\s(?P<command>[^\s]+)\s?(?P<parameters>[^:]+)?:?(?P<text>[^\r^\n]+)?'
-        match = re.match(regex, msg)
+        self.tags = {}
+        if msg.startswith('@'):
+            raw_tags, _, msg = msg.partition(' ')
+            self.tags = parse_tags(raw_tags[1:])
+
+        match = Message.regex.match(msg)
         self.valid_command = False
         self.is_message = False
+        self.nick = None
+        self.text = None
+        self.words = []
         if match:
             self.is_message = True
             self.raw_message = match.group(0)
@@ -24,9 +57,14 @@ class Message(object):
             self.command = match.group('command')
             self.parameters = match.group('parameters')
             self.text = match.group('text')
-            self.valid_command = self.text != None and self.text[0] == command_prefix
+            self.valid_command = self.command == 'PRIVMSG' and self.text != None and self.text[0] == command_prefix
             self.words = [word.rstrip(string.punctuation) for word in self.text.split()] if self.text != None else []
 
+        # the services account of the sender when the account-tag capability is enabled
+        self.account = self.tags.get('account')
+        self.batch = self.tags.get('batch')
+        self.label = self.tags.get('label')
+
     def __len__(self):
         if self.is_message:
             return len(self.text)
@@ -47,6 +85,108 @@ class Response(object):
         self.message = msg
         self.pm_user = pm_user
 
+"""
+An inbound BATCH being collected until the server closes it
+"""
+class Batch(object):
+    def __init__(self, reference, kind, parameters, label=None, parent=None):
+        self.reference = reference
+        self.kind = kind
+        self.parameters = parameters
+        self.label = label
+        self.parent = parent
+        self.messages = []
+
+"""
+The state of a single command invocation
+
+Commands receive a Context instead of the bot. It holds the message and the
+channel of this invocation and forwards every other attribute (reads and
+writes) to the bot, so commands written as command(bot) keep working while
+several of them run at the same time.
+"""
+class Context(object):
+    own_attributes = ('bot', 'message', 'current_channel')
+
+    def __init__(self, bot, message):
+        object.__setattr__(self, 'bot', bot)
+        object.__setattr__(self, 'message', message)
+        channel = message.channel_used()
+        if channel == bot.nickname:
+            channel = message.nick
+        object.__setattr__(self, 'current_channel', channel)
+
+    def __getattr__(self, name):
+        return getattr(self.bot, name)
+
+    def __setattr__(self, name, value):
+        if name in Context.own_attributes:
+            object.__setattr__(self, name, value)
+        else:
+            setattr(self.bot, name, value)
+
+"""
+Runs jobs on a fixed number of worker threads
+
+Jobs submitted with the same key always go to the same worker so they run
+in submission order, jobs with different keys usually run in parallel.
+With zero shards jobs run right away on the calling thread.
+"""
+class ShardedExecutor(object):
+    def __init__(self, shards=4):
+        self.queues = [Queue.Queue() for _ in range(shards)]
+        self.workers = []
+        # jobs submitted but not finished yet
+        self.pending = 0
+        self.idle = threading.Condition(threading.Lock())
+        for index, queue in enumerate(self.queues):
+            worker = threading.Thread(target=self._work, args=(queue,), name='dispatch-{}'.format(index))
+            worker.daemon = True
+            worker.start()
+            self.workers.append(worker)
+
+    def _work(self, queue):
+        while True:
+            job = queue.get()
+            if job is None:
+                break
+            function, args = job
+            try:
+                function(*args)
+            except Exception:
+                logger.exception('dispatch job failed')
+            finally:
+                with self.idle:
+                    self.pending -= 1
+                    if self.pending == 0:
+                        self.idle.notify_all()
+
+    def submit(self, key, function, *args):
+        if not self.queues:
+            function(*args)
+            return
+        with self.idle:
+            self.pending += 1
+        self.queues[hash(key) % len(self.queues)].put((function, args))
+
+    def wait_idle(self, timeout=None):
+        """Waits until every submitted job has finished, returns False on timeout"""
+        end = time.time() + timeout if timeout is not None else None
+        with self.idle:
+            while self.pending:
+                remaining = end - time.time() if end is not None else None
+                if remaining is not None and remaining <= 0:
+                    return False
+                self.idle.wait(remaining)
+        return True
+
+    def shutdown(self):
+        """Waits for the submitted jobs to finish and stops the workers"""
+        for queue in self.queues:
+            queue.put(None)
+        for worker in self.workers:
+            worker.join()
+
 class Bot(object):
     def __init__(self, **kwargs):
         self.server = kwargs['server']
@@ -55,10 +195,30 @@ class Bot(object):
         self.password = kwargs['password']
         self.port = kwargs.get('port', 6667)
         self.login_command = kwargs.get('login', None)
+        self.use_sasl = kwargs.get('sasl', False)
+        self.sasl_account = kwargs.get('sasl_account', self.nickname)
         self.response = ''
         self.commands = {}
+        # rendered by commands.botcommands on demand, reset whenever a command is added
+        self.help_catalog = None
         self.running = True
-        self.current_channel = ''
+        self.executor = ShardedExecutor(kwargs.get('dispatch_shards', 4))
+        # set by profiler.Profiler while a !profile is running
+        self.profiler = None
+        self.start_time = kwargs.get('start_time', time.time())
+        # enabled capability -> value advertised by the server (e.g. draft/multiline -> max-bytes=4096,max-lines=24)
+        self.capabilities = {}
+        self.authenticated = False
+        self.batches = {}
+        self.labels = {}
+        self.next_label = 0
+        self.buffer = ''
+        # lines received along with the end of registration, handled once run() starts
+        self.pending_lines = []
+        # callables run once by run() right after the JOINs are sent
+        self.after_join = []
+        self.send_lock = threading.Lock()
+        self.state = state.StateTracker(self.nickname)
 
         if self.login_command and not self.login_command.endswith('\r\n'):
             self.login_command = self.login_command + '\r\n'
@@ -66,46 +226,201 @@ class Bot(object):
         # actually connect
         self.irc = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
         self.irc.connect((self.server, self.port))
-        print('Setting User...')
-        self._send('USER {0} {0} {0} :{0}\r\n'.format(self.nickname))
-        print('Setting Nick...')
-        self._send('NICK {}\r\n'.format(self.nickname))
-
-        # this sleeping is required so we don't get some asynchronous sending
-        time.sleep(1)
-        self.sign_in()
-        time.sleep(1)
+        self.chat_server = self.server
+        self.register_connection()
+        if not self.authenticated:
+            self.sign_in()
 
     def _send(self, message):
-        self.irc.send(message)
-        self.response = self.irc.recv(2048).strip()
-        self.pong()
+        if not message.endswith('\r\n'):
+            message = message + '\r\n'
+        with self.send_lock:
+            self.irc.sendall(message)
+
+    def read_lines(self):
+        """Returns the complete lines received from the server, waiting for at least some data"""
+        data = self.irc.recv(4096)
+        if not data:
+            if self.running:
+                logger.warning('connection closed by the server')
+            self.running = False
+            return []
+        lines = (self.buffer + data).split('\n')
+        self.buffer = lines.pop()
+        return [line.rstrip('\r') for line in lines if line.strip()]
+
+    def register_connection(self):
+        """Negotiates the IRCv3 capabilities, authenticates through SASL if asked and registers the nick.
+
+           Servers that do not know about CAP simply ignore it and register the connection."""
+        logger.info('negotiating capabilities')
+        self._send('CAP LS 302')
+        self._send('NICK {}'.format(self.nickname))
+        self._send('USER {0} {0} {0} :{0}'.format(self.nickname))
+        available = {}
+        registered = False
+        while not registered:
+            lines = self.read_lines()
+            if not self.running:
+                raise socket.error('connection closed during registration')
+            for index, line in enumerate(lines):
+                if registered:
+                    self.pending_lines = lines[index:]
+                    break
+                self.response = line
+                message = Message(line)
+                if not message.is_message:
+                    continue
+                command = message.command
+                parameters = (message.parameters or '').split()
+                if command == 'PING':
+                    self.pong(message)
+                elif command == 'CAP' and len(parameters) >= 2:
+                    subcommand = parameters[1]
+                    if subcommand == 'LS':
+                        for capability in (message.text or '').split():
+                            name, _, value = capability.partition('=')
+                            available[name] = value
+                        if len(parameters) > 2 and parameters[2] == '*':
+                            # more LS lines are coming
+                            continue
+                        wanted = [name for name in wanted_capabilities if name in available]
+                        if self.use_sasl and 'sasl' in available:
+                            wanted.append('sasl')
+                        if wanted:
+                            self._send('CAP REQ :{}'.format(' '.join(wanted)))
+                        else:
+                            self._send('CAP END')
+                    elif subcommand == 'ACK':
+                        for name in (message.text or '').split():
+                            if name.startswith('-'):
+                                self.capabilities.pop(name[1:], None)
+                            else:
+                                self.capabilities[name] = available.get(name, '')
+                        if 'sasl' in self.capabilities:
+                            self._send('AUTHENTICATE PLAIN')
+                        else:
+                            self._send('CAP END')
+                    elif subcommand == 'NAK':
+                        self._send('CAP END')
+                elif command == 'AUTHENTICATE' and parameters == ['+']:
+                    self.send_sasl_credentials()
+                elif command in ('903', '907'):
+                    logger.info('authenticated through SASL')
+                    self.authenticated = True
+                    self._send('CAP END')
+                elif command in ('902', '904', '905', '906'):
+                    logger.warning('SASL authentication failed, falling back to NickServ: %s', message.text)
+                    self._send('CAP END')
+                elif command == '433':
+                    self.nickname = self.nickname + '_'
+                    self.state.nickname = self.nickname
+                    self._send('NICK {}'.format(self.nickname))
+                elif command == '001':
+                    registered = True
+                    self.chat_server = message.host
+        logger.info('registered', extra={'event': 'capabilities: ' + ' '.join(sorted(self.capabilities))})
+
+    def send_sasl_credentials(self):
+        payload = base64.b64encode('\0'.join([self.sasl_account, self.sasl_account, self.password]))
+        # the payload is sent in chunks of 400 bytes, with a lone + when it is an exact multiple
+        for index in range(0, len(payload), 400):
+            self._send('AUTHENTICATE {}'.format(payload[index:index + 400]))
+        if len(payload) % 400 == 0:
+            self._send('AUTHENTICATE +')
 
-    def pong(self):
-        result = re.search(r'PING :(.*)', self.response)
-        if result:
-            self.irc.send('PONG :{}\r\n'.format(result.group(1)))
+    def pong(self, message):
+        self._send('PONG :{}'.format(message.text or (message.parameters or '').strip()))
 
     def send_message(self, channel, message):
-        self.irc.send('PRIVMSG {} :{}\r\n'.format(channel, message))
+        self._send('PRIVMSG {} :{}'.format(channel, message))
+
+    def send_messages(self, channel, messages, on_reply=None):
+        """Sends several messages to a channel or user with a single write
+
+           When the server supports draft/multiline the messages are sent as
+           BATCHes (within its max-bytes and max-lines limits) so they are
+           delivered and rate limited as a single message.
+
+           When the server supports labeled-response, on_reply is called with
+           the list of Messages the server replied to the first line with (empty
+           once it was accepted, e.g. a 401 when the user is gone)."""
+        lines = []
+        if 'draft/multiline' in self.capabilities and len(messages) > 1:
+            for group in self.multiline_groups(messages):
+                if len(group) == 1:
+                    lines.append('PRIVMSG {} :{}'.format(channel, group[0]))
+                    continue
+                reference = 'ml{}'.format(self.new_label())
+                lines.append('BATCH +{} draft/multiline {}'.format(reference, channel))
+                for item in group:
+                    lines.append('@batch={} PRIVMSG {} :{}'.format(reference, channel, item))
+                lines.append('BATCH -{}'.format(reference))
+        else:
+            lines = ['PRIVMSG {} :{}'.format(channel, item) for item in messages]
+        if on_reply is not None and 'labeled-response' in self.capabilities and lines:
+            label = str(self.new_label())
+            self.labels[label] = on_reply
+            lines[0] = '@label={} {}'.format(label, lines[0])
+        self._send('\r\n'.join(lines))
+
+    def multiline_groups(self, messages):
+        """Splits messages into groups that each fit in one draft/multiline batch
+
+           The content of a batch is its messages joined by newlines, which must
+           not exceed max-bytes. A message too long for any batch is a group of
+           its own and is sent on its own."""
+        limits = dict(item.partition('=')[::2] for item in self.capabilities['draft/multiline'].split(',') if item)
+        max_lines = int(limits.get('max-lines') or len(messages))
+        # max-bytes is mandatory, the fallback is the usual limit of a single message
+        max_bytes = int(limits.get('max-bytes') or 512)
+        groups = []
+        group, size = [], 0
+        for item in messages:
+            length = len(item.encode('utf-8') if isinstance(item, unicode) else item)
+            added = length + 1 if group else length
+            if group and (len(group) >= max_lines or size + added > max_bytes):
+                groups.append(group)
+                group, size, added = [], 0, length
+            group.append(item)
+            size += added
+        if group:
+            groups.append(group)
+        return groups
+
+    def new_label(self):
+        # called from several dispatch workers at once
+        with self.send_lock:
+            self.next_label += 1
+            return self.next_label
 
     def disconnect(self, channel, message):
-        self.irc.send('PART {} :{}\r\n'.format(channel, message))
+        self._send('PART {} :{}'.format(channel, message))
         if channel in self.channels:
             self.channels.remove(channel)
 
         if len(self.channels) == 0:
-            self.running = False
+            self.stop()
 
     def quit(self):
-        for channel in self.channels:
+        for channel in list(self.channels):
             self.disconnect(channel, 'quitting bot')
+        self.stop()
+
+    def stop(self):
+        """Ends run(), which may be blocked reading from the server on another thread"""
         self.running = False
+        try:
+            # wakes up the read in run() right away
+            self.irc.shutdown(socket.SHUT_RD)
+        except socket.error:
+            pass
 
     def join(self):
         for channel in self.channels:
-            print('joining ' + channel)
-            self.irc.send('JOIN {}\r\n'.format(channel))
+            logger.info('joining channel', extra={'channel': channel})
+            self._send('JOIN {}'.format(channel))
+        logger.info('joined channels', extra={'latency_ms': (time.time() - self.start_time) * 1000.0})
 
     def add_owner(self, owner):
         self.owners.append(owner)
@@ -113,55 +428,144 @@ class Bot(object):
     def add_command(self, command):
         """Adds a command to the bot.
            A command is basically a python function associated. The command string is
-           equivalent to command_prefix + command.__name__. The command expects the bot
-           to be the parameter. The function is expected to return either a irc.Response or None.
+           equivalent to command_prefix + command.__name__. The command expects a Context
+           (which behaves like the bot for the current message) to be the parameter. The function is expected to return either a irc.Response or None.
            None denotes that no message will be sent to the IRC server, while a irc.Response will be sent.
            The irc.Response is split at '\\n' to denote multiple messages to send.
-           Note that you can also send a message through the member functions of the bot."""
+           Note that you can also send a message through the member functions of the bot.
+           Commands of the same channel run one at a time in order, but commands of
+           different channels may run concurrently."""
 
         self.commands[command_prefix + command.__name__.lower()] = command
+        self.help_catalog = None
 
     def sign_in(self):
-        print('signing in...')
+        logger.info('signing in')
         if self.login_command:
             self._send(self.login_command.format(pw=self.password, user=self.nickname))
         else:
-            self._send('PRIVMSG NickServ :identify {}\r\n'.format(self.password))
-        print(self.response)
+            self._send('PRIVMSG NickServ :identify {}'.format(self.password))
+
+    def handle_batch(self, message):
+        """Opens or closes an inbound BATCH, returns the Batch once the outermost one is closed"""
+        parameters = (message.parameters or '').split()
+        reference = parameters[0]
+        if reference.startswith('+'):
+            parent = message.batch if message.batch in self.batches else None
+            batch = Batch(reference[1:], parameters[1] if len(parameters) > 1 else '', parameters[2:], message.label, parent)
+            self.batches[batch.reference] = batch
+            return None
+
+        batch = self.batches.pop(reference[1:], None)
+        if batch is not None and batch.parent in self.batches:
+            # a nested batch is delivered as part of the outer one
+            self.batches[batch.parent].messages.extend(batch.messages)
+            return None
+        return batch
+
+    def handle_line(self, line):
+        self.response = line
+        message = Message(line)
+        if not message.is_message:
+            return
+
+        if message.command == 'PING':
+            self.pong(message)
+            return
+
+        if message.command == 'BATCH':
+            batch = self.handle_batch(message)
+            if batch is None:
+                return
+            if batch.label is not None:
+                callback = self.labels.pop(batch.label, None)
+                if callback:
+                    callback(batch.messages)
+                return
+            # history playback must never run old commands again
+            for item in batch.messages:
+                self.handle_message(item, dispatch=batch.kind != 'chathistory')
+            return
+
+        if message.batch in self.batches:
+            self.batches[message.batch].messages.append(message)
+            return
+
+        if message.label is not None and message.label in self.labels:
+            callback = self.labels.pop(message.label)
+            callback([] if message.command == 'ACK' else [message])
+            return
+
+        self.handle_message(message)
+
+    def handle_message(self, message, dispatch=True):
+        self.state.feed(message)
+        if message.command == 'NICK' and message.nick == self.nickname:
+            self.nickname = self.state.nickname
+
+        # force sign-in, again >_>
+        if message.command == 'NOTICE' and '{} is a registered nick'.format(self.nickname) in (message.text or ''):
+            self.sign_in()
+            self.join()
+            return
+
+        if not dispatch or not message.valid_command:
+            return
+
+        context = Context(self, message)
+        name = message.words[0].lower()
+        function = self.commands.get(name, None)
+        if function == None:
+            logger.info('unknown command', extra={'channel': context.current_channel, 'nick': message.nick,
+                                                  'command': name, 'sample': 10})
+            return
+        # commands of one channel run in order, different channels run concurrently
+        # (the commands that rewrite shared files lock them, see commands.py)
+        self.executor.submit(context.current_channel.lower(), self.execute, context, function, name)
+
+    def execute(self, context, function, name):
+        """Runs a command for the given Context and sends its Response"""
+        start = time.time()
+        try:
+            profiler = self.profiler
+            if profiler is None:
+                result = function(context)
+            else:
+                result = profiler.run(function, context, name)
+            if result:
+                target = context.current_channel if not result.pm_user else context.message.nick
+                self.send_messages(target, result.message.split('\n'), self.delivery_check(context, name, target))
+        except Exception as e:
+            logger.exception('command failed', extra={'channel': context.current_channel, 'nick': context.message.nick,
+                                                      'command': name})
+            return
+        logger.info('command', extra={'channel': context.current_channel, 'nick': context.message.nick, 'command': name,
+                                      'latency_ms': (time.time() - start) * 1000.0})
+
+    def delivery_check(self, context, name, target):
+        """Returns the on_reply callback for send_messages that logs the replies the server could not deliver"""
+        def on_reply(replies):
+            for reply in replies:
+                # error numerics, e.g. 401 no such nick or 404 cannot send to channel
+                if (reply.command or '').isdigit() and reply.command[0] in '45':
+                    logger.warning('reply not delivered: %s', reply.text, extra={'channel': context.current_channel,
+                                   'nick': context.message.nick, 'command': name, 'target': target})
+                    return
+        return on_reply
 
     def run(self):
-        server_match = re.search(r'\:Your host is (.*),', self.response)
-        self.chat_server = server_match.group(1) if server_match else self.server
-        print('The chat server found is ' + self.chat_server)
+        logger.info('chat server found: %s', self.chat_server)
         self.join()
+        # the server handles the JOINs before anything these send
+        for callback in self.after_join:
+            callback()
+        self.after_join = []
+        for line in self.pending_lines:
+            self.handle_line(line)
+        self.pending_lines = []
         while self.running:
-            self.response = self.irc.recv(2048).strip()
-            self.pong()
-
-            # force sign-in, again >_>
-            if '{} is a registered nick'.format(self.nickname) in self.response:
-                self.sign_in()
-                self.join()
-
-            if self.chat_server in self.response:
-                continue
-
-            self.message = Message(self.response)
-            self.current_channel = self.message.channel_used()
-            if self.current_channel == self.nickname:
-                self.current_channel = self.message.nick
-
-            if self.message.valid_command:
-                print(self.response)
-                function = self.commands.get(self.message.words[0].lower(), None)
-                if function == None:
-                    print('unknown command found : ' + self.message.text)
-                try:
-                    result = function(self)
-                    if result:
-                        messages = result.message.split('\n')
-                        for item in messages:
-                            self.send_message(self.current_channel if not result.pm_user else self.message.nick, item)
-                except Exception as e:
-                    print('error found:')
-                    print(traceback.format_exc())
+            for line in self.read_lines():
+                self.handle_line(line)
+                if not self.running:
+                    break
+        self.executor.shutdown()
@@ -0,0 +1,453 @@
+#!/usr/bin/env python
+
+"""Offline replay and load-testing harness for the bot.
+
+Runs an irc.Bot against a local fake IRC server (and optionally a stub
+Challonge HTTP server) and feeds it recorded or synthetic traffic at a
+configurable rate. At the end it reports how fast the traffic was drained,
+command latency percentiles and the outbound message rate.
+
+Examples:
+    python loadtest.py synthetic --lines 5000 --rate 500
+    python loadtest.py synthetic --mix command,prepare --prepare 256
+    python loadtest.py replay traffic.log --rate 200 --json results.json
+"""
+
+import argparse
+import json
+import os
+import random
+import re
+import shutil
+import socket
+import tempfile
+import threading
+import time
+import BaseHTTPServer
+
+import irc
+import commands
+import ranking as seasonal
+
+probe_regex = re.compile(r'probe(\d+)')
+
+def percentile(values, pct):
+    """Returns the pct-th percentile of a list of numbers (nearest rank)"""
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    index = int(round(pct / 100.0 * (len(ordered) - 1)))
+    return ordered[index]
+
+"""A fake IRC server that accepts a single bot connection
+
+It answers just enough of the registration dance for irc.Bot to get through
+its constructor and records everything the bot sends back."""
+class FakeIRCServer(object):
+    def __init__(self, name='irc.fake.test', host='127.0.0.1', port=0, capabilities=()):
+        self.name = name
+        self.capabilities = list(capabilities)
+        self.negotiating = False
+        self.registered = False
+        self.user_seen = False
+        self.listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.listener.bind((host, port))
+        self.listener.listen(1)
+        self.host = host
+        self.port = self.listener.getsockname()[1]
+        self.client = None
+        self.nickname = None
+        self.channels = set()
+        self.joined = threading.Event()
+        self.parted = threading.Event()
+        self.lock = threading.Lock()
+        self.outbound = []
+        self.pongs = {}
+        self.pong_event = threading.Condition(self.lock)
+        self.probe_replies = {}
+        self.expected_channels = 1
+
+    def start(self):
+        thread = threading.Thread(target=self._serve)
+        thread.daemon = True
+        thread.start()
+
+    def send(self, *lines):
+        self.client.sendall(''.join(line + '\r\n' for line in lines))
+
+    def close(self):
+        for sock in (self.client, self.listener):
+            try:
+                if sock:
+                    sock.close()
+            except socket.error:
+                pass
+
+    def wait_for_pong(self, token, timeout):
+        end = time.time() + timeout
+        with self.lock:
+            while token not in self.pongs:
+                remaining = end - time.time()
+                if remaining <= 0:
+                    return None
+                self.pong_event.wait(remaining)
+            return self.pongs[token]
+
+    def _serve(self):
+        self.client, _ = self.listener.accept()
+        self.client.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        buffer = ''
+        while True:
+            try:
+                data = self.client.recv(4096)
+            except socket.error:
+                break
+            if not data:
+                break
+            buffer += data
+            lines = buffer.split('\n')
+            buffer = lines.pop()
+            for line in lines:
+                self._handle(line.strip('\r'))
+
+    def _welcome(self):
+        # registration is held until CAP END like real servers do
+        if self.registered or self.negotiating or not (self.user_seen and self.nickname):
+            return
+        self.registered = True
+        self.send(':{0} 001 {1} :Welcome to the fake network {1}'.format(self.name, self.nickname),
+                  ':{0} 002 {1} :Your host is {0}, running version fake-1.0'.format(self.name, self.nickname))
+
+    def _handle(self, line):
+        now = time.time()
+        if line.startswith('@'):
+            tags, _, line = line[1:].partition(' ')
+            label = irc.parse_tags(tags).get('label')
+            if label is not None:
+                # labeled-response: a PRIVMSG has no reply of its own, only the ACK
+                self.send('@label={} :{} ACK'.format(label, self.name))
+        parts = line.split(' ', 2)
+        command = parts[0].upper()
+        if command == 'CAP':
+            subcommand = parts[1].upper()
+            if subcommand == 'LS':
+                self.negotiating = True
+                self.send(':{} CAP * LS :{}'.format(self.name, ' '.join(self.capabilities)))
+            elif subcommand == 'REQ':
+                requested = parts[2].lstrip(':').split()
+                if all(cap in self.capabilities for cap in requested):
+                    self.send(':{} CAP * ACK :{}'.format(self.name, ' '.join(requested)))
+                else:
+                    self.send(':{} CAP * NAK :{}'.format(self.name, ' '.join(requested)))
+            elif subcommand == 'END':
+                self.negotiating = False
+                self._welcome()
+        elif command == 'USER':
+            self.user_seen = True
+            self.send(':{} NOTICE * :*** Checking Ident'.format(self.name))
+            self._welcome()
+        elif command == 'NICK':
+            self.nickname = parts[1]
+            self._welcome()
+        elif command == 'JOIN':
+            for channel in parts[1].split(','):
+                self.channels.add(channel)
+                self.send(':{0}!{0}@bot.test JOIN {1}'.format(self.nickname, channel))
+            if len(self.channels) >= self.expected_channels:
+                self.joined.set()
+        elif command == 'PONG':
+            token = line.split(':', 1)[-1].strip()
+            with self.lock:
+                self.pongs[token] = now
+                self.pong_event.notify_all()
+        elif command == 'PRIVMSG' and len(parts) == 3:
+            target, text = parts[1], parts[2][1:]
+            if target == 'NickServ':
+                self.send(':NickServ!NickServ@services.test NOTICE {} :Password accepted'.format(self.nickname))
+                return
+            with self.lock:
+                self.outbound.append((now, target, text))
+                for match in probe_regex.finditer(text):
+                    self.probe_replies.setdefault(int(match.group(1)), now)
+        elif command in ('PART', 'QUIT'):
+            self.parted.set()
+
+"""A stub of the Challonge v1 API serving canned tournament payloads
+
+Writes (PUT/DELETE on participants) are accepted and counted but do not
+modify the payloads."""
+class FakeChallongeServer(object):
+    def __init__(self, host='127.0.0.1', port=0):
+        self.tournaments = {}
+        self.requests = []
+        server = self
+
+        class Handler(BaseHTTPServer.BaseHTTPRequestHandler):
+            def _reply(self, status, body):
+                data = json.dumps(body)
+                self.send_response(status)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+
+            def _route(self):
+                path = self.path.split('?', 1)[0]
+                server.requests.append((self.command, path))
+                m = re.match(r'/v1/tournaments/(?P<url>[^/]+?)(?:/participants/(?P<pid>\d+))?\.json$', path)
+                if m is None or m.group('url') not in server.tournaments:
+                    return self._reply(404, {'errors': ['Requested tournament was not found.']})
+                if m.group('pid') is None:
+                    return self._reply(200, {'tournament': server.tournaments[m.group('url')]})
+                return self._reply(200, {'participant': {'id': int(m.group('pid'))}})
+
+            do_GET = do_PUT = do_DELETE = _route
+
+            def log_message(self, *args):
+                pass
+
+        self.httpd = BaseHTTPServer.HTTPServer((host, port), Handler)
+        self.port = self.httpd.server_address[1]
+        self.base_url = 'http://{}:{}/v1'.format(host, self.port)
+
+    def start(self):
+        thread = threading.Thread(target=self.httpd.serve_forever)
+        thread.daemon = True
+        thread.start()
+
+    def close(self):
+        self.httpd.shutdown()
+
+    def write_count(self):
+        return sum(1 for method, path in self.requests if method in ('PUT', 'DELETE'))
+
+def make_tournament(entrants, game_id=16869, state='checked_in'):
+    """Returns a minimal Challonge-shaped tournament payload for !prepare"""
+    participants = []
+    for index in range(entrants):
+        participants.append({'participant': {
+            'id': 1000 + index,
+            'seed': index + 1,
+            'checked_in': True,
+            'challonge_username': 'player{}'.format(index),
+            'display_name': 'player{}'.format(index),
+        }})
+    return {'state': state, 'game_id': game_id, 'participants': participants, 'matches': []}
+
+"""Generates synthetic server -> client traffic
+
+Each item produced is a tuple of (lines, probe) where lines is a list of raw
+IRC lines that are sent in a single write and probe is the probe number the
+lines carry (or None)."""
+class TrafficGenerator(object):
+    words = ['gg', 'who', 'is', 'up', 'next', 'bracket', 'lag', 'wifi', 'fox', 'marth', 'ledge', 'pools', 'set']
+    static_commands = ['!phonebook', '!faq', '!form', '!conduct', '!tutorial', '!ranking', '!calendar', '!bracket', '!rules']
+
+    def __init__(self, channel, mix, seed=0, burst_size=8, owner='owner'):
+        self.channel = channel
+        self.mix = mix
+        self.random = random.Random(seed)
+        self.burst_size = burst_size
+        self.owner = owner
+        self.probes = 0
+
+    def _prefix(self, nick):
+        return ':{0}!~{0}@user/{0}/x-1'.format(nick)
+
+    def _privmsg(self, nick, text, target=None):
+        return '{} PRIVMSG {} :{}'.format(self._prefix(nick), target or self.channel, text)
+
+    def _nick(self):
+        return 'user{}'.format(self.random.randint(0, 499))
+
+    def chatter(self):
+        text = ' '.join(self.random.choice(self.words) for _ in range(self.random.randint(2, 12)))
+        return [self._privmsg(self._nick(), text)], None
+
+    def command(self):
+        if self.random.random() < 0.5:
+            self.probes += 1
+            return [self._privmsg(self._nick(), '!rank 3ds probe{}'.format(self.probes))], self.probes
+        return [self._privmsg(self._nick(), self.random.choice(self.static_commands))], None
+
+    def ping(self):
+        return ['PING :{}'.format(self.random.randint(0, 1 << 30))], None
+
+    def burst(self):
+        lines = []
+        for _ in range(self.burst_size):
+            lines.extend(self.chatter()[0])
+        return lines, None
+
+    def unknown(self):
+        return [self._privmsg(self._nick(), '!nosuchcommand')], None
+
+    def prepare(self):
+        return [self._privmsg(self.owner, '!prepare http://challonge.com/bench')], None
+
+    def generate(self, count):
+        kinds = [getattr(self, kind) for kind in self.mix]
+        for _ in range(count):
+            yield self.random.choice(kinds)()
+
+def read_recording(filename):
+    """Reads a recorded traffic file of raw IRC lines (blank lines and # comments are skipped)"""
+    with open(filename) as f:
+        for line in f:
+            line = line.rstrip('\r\n')
+            if not line or line.startswith('#'):
+                continue
+            match = probe_regex.search(line)
+            yield [line], int(match.group(1)) if match else None
+
+def run_load(traffic, rate, server, bot, drain_timeout=60.0):
+    """Sends the traffic to the connected bot at the given rate (in writes/second) and collects statistics"""
+    sent_probes = {}
+    lines_sent = 0
+    interval = 1.0 / rate if rate > 0 else 0.0
+    start = time.time()
+    for index, (lines, probe) in enumerate(traffic):
+        if interval:
+            delay = start + index * interval - time.time()
+            if delay > 0:
+                time.sleep(delay)
+        now = time.time()
+        if probe is not None:
+            sent_probes[probe] = now
+        server.send(*lines)
+        lines_sent += len(lines)
+    send_end = time.time()
+
+    # a PING is answered once the bot has read everything before it, the commands
+    # it dispatched are done once its executor is idle, and the PONG to a second
+    # PING arrives after all of their replies
+    deadline = time.time() + drain_timeout
+    server.send('PING :drain')
+    drained = server.wait_for_pong('drain', drain_timeout) is not None
+    drained = drained and bot.executor.wait_idle(max(0.0, deadline - time.time()))
+    if drained:
+        server.send('PING :replies')
+        drained = server.wait_for_pong('replies', max(0.0, deadline - time.time())) is not None
+    end = time.time()
+
+    with server.lock:
+        outbound = [item for item in server.outbound if item[0] >= start]
+        replies = dict(server.probe_replies)
+
+    latencies = [replies[probe] - sent for probe, sent in sent_probes.items() if probe in replies]
+    elapsed = end - start
+    return {
+        'lines_sent': lines_sent,
+        'send_seconds': send_end - start,
+        'drain_seconds': elapsed,
+        'drained': drained,
+        'lines_per_second': lines_sent / elapsed if elapsed > 0 else 0.0,
+        'commands_probed': len(sent_probes),
+        'commands_answered': len(latencies),
+        'latency_ms': {
+            'p50': percentile(latencies, 50) * 1000.0,
+            'p90': percentile(latencies, 90) * 1000.0,
+            'p99': percentile(latencies, 99) * 1000.0,
+            'max': max(latencies) * 1000.0 if latencies else 0.0,
+        },
+        'outbound_messages': len(outbound),
+        'outbound_per_second': len(outbound) / elapsed if elapsed > 0 else 0.0,
+    }
+
+def start_bot(conf):
+    """Creates the bot (which connects in its constructor) and runs it on a background thread"""
+    bot = irc.Bot(**conf)
+    commands.register(bot)
+    thread = threading.Thread(target=bot.run)
+    thread.daemon = True
+    thread.start()
+    return bot, thread
+
+def make_workspace(entrants):
+    """Creates a scratch directory holding the files the commands read and write"""
+    workspace = tempfile.mkdtemp(prefix='hypestbot-load-')
+    directory = os.path.join(workspace, 'rankings')
+    os.mkdir(directory)
+    db = {}
+    for index in range(entrants):
+        name = 'player{}'.format(index)
+        db[name] = {'challonge_username': name, 'rating': entrants - index, 'wins': 0, 'losses': 0, 'ties': 0}
+    for filename in set(seasonal.game_to_filename.values()):
+        with open(os.path.join(directory, filename), 'w') as f:
+            json.dump(db if filename == 'ssb3ds.json' else {}, f)
+    return workspace, directory
+
+def main():
+    parser = argparse.ArgumentParser(description='Offline load-testing harness for HypestBot')
+    sub = parser.add_subparsers(dest='mode')
+    synthetic = sub.add_parser('synthetic', help='generate synthetic traffic')
+    synthetic.add_argument('--lines', type=int, default=2000, help='number of writes to send')
+    synthetic.add_argument('--mix', default='chatter,command,ping,burst',
+                           help='comma separated traffic kinds (chatter, command, ping, burst, unknown, prepare)')
+    synthetic.add_argument('--burst-size', type=int, default=8)
+    synthetic.add_argument('--seed', type=int, default=0)
+    replay = sub.add_parser('replay', help='replay a recorded traffic file')
+    replay.add_argument('recording')
+    for p in (synthetic, replay):
+        p.add_argument('--rate', type=float, default=200.0, help='writes per second (0 = as fast as possible)')
+        p.add_argument('--prepare', type=int, default=64, help='entrants in the stub Challonge tournament')
+        p.add_argument('--json', help='write the results to this file')
+        p.add_argument('--caps', default='', help='comma separated IRCv3 capabilities the fake server offers')
+    args = parser.parse_args()
+
+    channel = '#loadtest'
+    irc_server = FakeIRCServer(capabilities=[cap for cap in args.caps.split(',') if cap])
+    irc_server.start()
+    challonge = FakeChallongeServer()
+    challonge.start()
+    challonge.tournaments['bench'] = make_tournament(args.prepare)
+    seasonal.Challonge.API_BASE_URL = challonge.base_url
+
+    cwd = os.getcwd()
+    workspace, directory = make_workspace(args.prepare)
+    os.chdir(workspace)
+    try:
+        commands.conf = {
+            'server': irc_server.host,
+            'port': irc_server.port,
+            'channels': [channel],
+            'nickname': 'LoadBot',
+            'password': 'hunter2',
+            'owners': ['owner'],
+            'bracket': {channel: 'http://challonge.com/bench'},
+            'rules': {channel: 'http://example.com/rules'},
+            'ranking_directory': directory,
+            'challonge': 'stub-key',
+        }
+        bot_conf = dict((k, commands.conf[k]) for k in ('server', 'port', 'nickname', 'password'))
+        bot_conf['channels'] = list(commands.conf['channels'])
+        bot, thread = start_bot(bot_conf)
+        if not irc_server.joined.wait(30):
+            raise RuntimeError('bot never joined {}'.format(channel))
+
+        if args.mode == 'replay':
+            traffic = read_recording(args.recording)
+        else:
+            generator = TrafficGenerator(channel, args.mix.split(','), seed=args.seed, burst_size=args.burst_size)
+            traffic = generator.generate(args.lines)
+
+        results = run_load(traffic, args.rate, irc_server, bot)
+        results['challonge_requests'] = len(challonge.requests)
+        results['challonge_writes'] = challonge.write_count()
+
+        irc_server.send(':owner!~owner@user/owner PRIVMSG {} :!quit'.format(channel))
+        thread.join(10)
+    finally:
+        os.chdir(cwd)
+        irc_server.close()
+        challonge.close()
+        shutil.rmtree(workspace, ignore_errors=True)
+
+    print(json.dumps(results, sort_keys=True, indent=4))
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(results, f, sort_keys=True, indent=4)
+
+if __name__ == '__main__':
+    main()
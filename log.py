@@ -0,0 +1,161 @@
+import json
+import logging
+import logging.handlers
+import threading
+import Queue
+
+"""Structured, non-blocking logging for the bot
+
+Records are pushed onto an in-memory queue by QueueHandler and written by a
+single background thread (QueueListener), so the main loop never waits on a
+slow stdout pipe, journal or disk. Records are written as one JSON object per
+line with any of the structured fields (channel, nick, command, latency_ms,
+...) passed through `extra`.
+
+Usage:
+    logger = log.get_logger('irc')
+    logger.info('command', extra={'channel': '#chan', 'nick': 'foo', 'command': '!rank', 'latency_ms': 1.2})
+    logger.info('unknown command', extra={'sample': 10})  # only 1 in 10 is kept"""
+
+# structured fields copied from the record into the JSON output when present
+fields = ('channel', 'nick', 'command', 'latency_ms', 'event', 'sampled', 'lines', 'target')
+
+# stay silent until setup() is called (e.g. when imported by loadtest.py)
+logging.getLogger('hypestbot').addHandler(logging.NullHandler())
+
+def get_logger(name):
+    return logging.getLogger('hypestbot.' + name)
+
+"""A handler that only enqueues records, never blocks and drops records when the queue is full"""
+class QueueHandler(logging.Handler):
+    def __init__(self, queue):
+        logging.Handler.__init__(self)
+        self.queue = queue
+        self.dropped = 0
+
+    def emit(self, record):
+        if record.exc_info:
+            # tracebacks reference frames that may change by the time the listener runs
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+        try:
+            self.queue.put_nowait(record)
+        except Queue.Full:
+            self.dropped += 1
+
+"""The background thread that drains the queue into the real handlers"""
+class QueueListener(threading.Thread):
+    _sentinel = None
+
+    def __init__(self, queue, *handlers):
+        threading.Thread.__init__(self, name='log-listener')
+        self.daemon = True
+        self.queue = queue
+        self.handlers = handlers
+
+    def run(self):
+        while True:
+            record = self.queue.get()
+            if record is self._sentinel:
+                break
+            for handler in self.handlers:
+                if record.levelno >= handler.level:
+                    try:
+                        handler.handle(record)
+                    except Exception:
+                        handler.handleError(record)
+
+    def stop(self):
+        self.queue.put(self._sentinel)
+        self.join()
+        for handler in self.handlers:
+            handler.flush()
+            # releases the log file, setup() opens a new one on every !refresh
+            handler.close()
+
+"""Formats a record as a single line of JSON"""
+class JsonFormatter(logging.Formatter):
+    def format(self, record):
+        entry = {
+            'time': record.created,
+            'level': record.levelname,
+            'logger': record.name,
+            'message': record.getMessage(),
+        }
+        for field in fields:
+            value = getattr(record, field, None)
+            if value is not None:
+                entry[field] = value
+        if record.exc_text:
+            entry['traceback'] = record.exc_text
+        return json.dumps(entry, ensure_ascii=False)
+
+"""Keeps only one in N records for records that carry extra={'sample': N}
+
+Kept records get a 'sampled' field with N so counts can be scaled back up
+when querying. Sampling is done per message so that rare events are not
+drowned out by common ones."""
+class SampleFilter(logging.Filter):
+    def __init__(self):
+        logging.Filter.__init__(self)
+        self.counters = {}
+
+    def filter(self, record):
+        rate = getattr(record, 'sample', None)
+        if not rate or rate <= 1:
+            return True
+        key = record.msg
+        count = self.counters.get(key, 0)
+        self.counters[key] = count + 1
+        if count % rate != 0:
+            return False
+        record.sampled = rate
+        return True
+
+# kept across reload() so that the next setup() still stops the running listener
+try:
+    listener
+except NameError:
+    listener = None
+
+def setup(conf):
+    """Configures the bot loggers from the configuration dictionary
+
+    Recognised keys are log_file (default hypestbot.log), log_level (default INFO),
+    log_max_bytes, log_backups and log_queue_size. Calling it again replaces the
+    previous configuration."""
+    global listener
+    logger = logging.getLogger('hypestbot')
+    for handler in list(logger.handlers):
+        logger.removeHandler(handler)
+    if listener is not None:
+        listener.stop()
+
+    level = getattr(logging, str(conf.get('log_level', 'INFO')).upper(), logging.INFO)
+    logger.setLevel(level)
+    logger.propagate = False
+
+    file_handler = logging.handlers.RotatingFileHandler(conf.get('log_file', 'hypestbot.log'),
+                                                        maxBytes=conf.get('log_max_bytes', 10 * 1024 * 1024),
+                                                        backupCount=conf.get('log_backups', 5))
+    file_handler.setFormatter(JsonFormatter())
+
+    # warnings and errors still make it to the console, but off the main thread
+    console = logging.StreamHandler()
+    console.setLevel(logging.WARNING)
+    console.setFormatter(logging.Formatter('%(asctime)s %(levelname)s %(name)s: %(message)s'))
+
+    queue = Queue.Queue(conf.get('log_queue_size', 10000))
+    listener = QueueListener(queue, file_handler, console)
+    listener.start()
+    handler = QueueHandler(queue)
+    handler.addFilter(SampleFilter())
+    logger.addHandler(handler)
+    return logger
+
+def shutdown():
+    """Flushes any queued records, to be called before the process exits"""
+    global listener
+    if listener is not None:
+        listener.stop()
+        listener = None
@@ -0,0 +1,87 @@
+import os
+import sys
+import imp
+import importlib
+import struct
+
+"""Loads the plugin modules and reloads the ones that changed
+
+A plugin module provides a register(bot) function that adds its commands,
+like commands.register. The loader remembers the modification time of every
+module imported from its directory, including the ones the commands import
+lazily (ranking, seeding, ...), so that !refresh only reloads the modules
+whose source changed since."""
+class PluginLoader(object):
+    def __init__(self, modules=None, directory=None):
+        self.modules = list(modules or ['commands'])
+        self.directory = directory or os.path.dirname(os.path.abspath(__file__))
+        # module name -> mtime at the time it was imported or reloaded
+        self.loaded = {}
+
+    def source(self, module_name):
+        return os.path.join(self.directory, module_name.replace('.', os.sep) + '.py')
+
+    def mtime(self, module_name):
+        # whole seconds, like the modification time recorded in .pyc files
+        try:
+            return int(os.path.getmtime(self.source(module_name)))
+        except OSError:
+            return None
+
+    def imported_mtime(self, module_name):
+        """Returns the modification time of the source the module was compiled from
+
+        That is the one recorded in its .pyc file, the current one when there is
+        no up to date .pyc to tell."""
+        try:
+            with open(self.source(module_name) + 'c', 'rb') as f:
+                header = f.read(8)
+        except IOError:
+            header = ''
+        if len(header) == 8 and header[:4] == imp.get_magic():
+            return struct.unpack('<I', header[4:])[0]
+        return self.mtime(module_name)
+
+    def load(self, module_name):
+        """Imports the module if needed and returns it"""
+        module = sys.modules.get(module_name)
+        if module is None:
+            module = importlib.import_module(module_name)
+        if module_name not in self.loaded:
+            self.track(module_name)
+        return module
+
+    def register(self, bot):
+        """Calls register(bot) of every plugin module"""
+        for module_name in self.modules:
+            self.load(module_name).register(bot)
+        self.discover()
+
+    def track(self, module_name):
+        """Starts watching an already imported module for reload_changed"""
+        self.loaded[module_name] = self.imported_mtime(module_name)
+
+    def discover(self):
+        """Tracks the modules imported from the directory since the last call"""
+        for module_name, module in sys.modules.items():
+            if module_name in self.loaded or module_name == '__main__' or module is None:
+                continue
+            filename = getattr(module, '__file__', None)
+            if filename and os.path.dirname(os.path.abspath(filename)) == self.directory:
+                self.track(module_name)
+
+    def reload_changed(self):
+        """Reloads the imported modules whose source changed since they were loaded
+
+        Returns the list of reloaded module names."""
+        self.discover()
+        changed = []
+        for module_name, mtime in list(self.loaded.items()):
+            module = sys.modules.get(module_name)
+            current = self.mtime(module_name)
+            if module is None or current == mtime:
+                continue
+            reload(module)
+            self.loaded[module_name] = current
+            changed.append(module_name)
+        return changed
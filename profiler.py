@@ -0,0 +1,178 @@
+import cProfile
+import pstats
+import os
+import sys
+import threading
+import time
+from collections import Counter
+
+import log
+
+"""On-demand profiling of command dispatch
+
+A Profiler is attached to the bot as bot.profiler while it runs. irc.Bot.execute
+only checks that attribute, so there is no cost when nothing is being profiled.
+
+Two modes are supported:
+- cprofile runs every dispatched command under its own cProfile.Profile (the
+  profiler is per thread and commands run on the dispatch workers) and merges
+  them into a single pstats file.
+- sample looks at the stacks of the threads running a command every few
+  milliseconds and writes them in the collapsed stack format used by flame
+  graph tools. Idle workers and the other bot threads are left out.
+
+Either way the wall time of every command is recorded and a top 10 summary is
+sent to the owner who started it."""
+
+logger = log.get_logger('profiler')
+
+class Profiler(object):
+    def __init__(self, bot, nick, mode='cprofile', seconds=None, commands=None, directory='profiles', interval=0.005):
+        self.bot = bot
+        self.nick = nick
+        self.mode = mode
+        self.seconds = seconds
+        self.max_commands = commands
+        self.directory = directory
+        self.interval = interval
+        self.lock = threading.Lock()
+        self.profiles = []
+        self.samples = Counter()
+        # ident -> number of commands running on that thread
+        self.active = Counter()
+        # command name -> list of wall times in seconds
+        self.timings = {}
+        self.count = 0
+        self.finished = False
+        self.stopped = threading.Event()
+        self.started = None
+        self.sampler = None
+
+    def start(self):
+        self.started = time.time()
+        if self.mode == 'sample':
+            self.sampler = threading.Thread(target=self._sample, name='sampler')
+            self.sampler.daemon = True
+            self.sampler.start()
+        if self.seconds is not None:
+            timer = threading.Timer(self.seconds, self.finish)
+            timer.daemon = True
+            timer.start()
+        self.bot.profiler = self
+
+    def run(self, function, context, name):
+        """Runs a command the way irc.Bot.execute would, while profiling it"""
+        start = time.time()
+        ident = threading.current_thread().ident
+        with self.lock:
+            self.active[ident] += 1
+        try:
+            if self.mode == 'cprofile':
+                profile = cProfile.Profile()
+                try:
+                    return profile.runcall(function, context)
+                finally:
+                    with self.lock:
+                        self.profiles.append(profile)
+            return function(context)
+        finally:
+            elapsed = time.time() - start
+            with self.lock:
+                self.active[ident] -= 1
+                if not self.active[ident]:
+                    del self.active[ident]
+                self.timings.setdefault(name, []).append(elapsed)
+                self.count += 1
+                done = self.max_commands is not None and self.count >= self.max_commands
+            if done:
+                self.finish()
+
+    def _sample(self):
+        while not self.stopped.is_set():
+            with self.lock:
+                active = set(self.active)
+            for ident, frame in sys._current_frames().items():
+                if ident not in active:
+                    continue
+                stack = []
+                while frame is not None:
+                    code = frame.f_code
+                    stack.append('{}:{}'.format(os.path.basename(code.co_filename), code.co_name))
+                    frame = frame.f_back
+                self.samples[';'.join(reversed(stack))] += 1
+            self.stopped.wait(self.interval)
+
+    def finish(self):
+        """Stops profiling, writes the results and sends the summary"""
+        with self.lock:
+            if self.finished:
+                return
+            self.finished = True
+        self.stopped.set()
+        if self.sampler is not None:
+            self.sampler.join()
+        if getattr(self.bot, 'profiler', None) is self:
+            self.bot.profiler = None
+
+        try:
+            filename = self.write()
+            elapsed = time.time() - self.started
+            if filename is None:
+                lines = ['nothing was profiled over {:.1f}s ({} commands), no file written'.format(elapsed, self.count)]
+            else:
+                lines = ['profile of {} commands over {:.1f}s written to {}'.format(self.count, elapsed, filename)]
+                lines.extend(self.summary())
+            self.bot.send_messages(self.nick, lines)
+        except Exception:
+            logger.exception('unable to write the profile')
+
+    def write(self):
+        """Writes the profile and returns its filename, None if nothing was profiled"""
+        stats = self.stats() if self.mode != 'sample' else None
+        if not self.samples and stats is None:
+            return None
+        if not os.path.isdir(self.directory):
+            os.makedirs(self.directory)
+        stamp = time.strftime('%Y%m%d-%H%M%S')
+        if self.mode == 'sample':
+            filename = os.path.join(self.directory, 'profile-{}.collapsed'.format(stamp))
+            with open(filename, 'w') as f:
+                for stack, count in self.samples.most_common():
+                    f.write('{} {}\n'.format(stack, count))
+            return filename
+
+        filename = os.path.join(self.directory, 'profile-{}.pstats'.format(stamp))
+        stats.dump_stats(filename)
+        return filename
+
+    def stats(self):
+        if not self.profiles:
+            return None
+        stats = pstats.Stats(self.profiles[0])
+        for profile in self.profiles[1:]:
+            stats.add(profile)
+        return stats
+
+    def summary(self, limit=10):
+        """Returns the top commands by total time and the top functions as lines of text"""
+        lines = []
+        totals = sorted(self.timings.items(), key=lambda item: sum(item[1]), reverse=True)
+        for name, times in totals[:limit]:
+            lines.append('{}: {} calls, {:.1f}ms avg, {:.1f}ms max'.format(name, len(times), 1000.0 * sum(times) / len(times), 1000.0 * max(times)))
+
+        if self.mode == 'sample':
+            leaves = Counter()
+            for stack, count in self.samples.iteritems():
+                leaves[stack.rsplit(';', 1)[-1]] += count
+            total = sum(leaves.values()) or 1
+            for leaf, count in leaves.most_common(limit):
+                lines.append('{} {:.1f}% of samples'.format(leaf, 100.0 * count / total))
+            return lines
+
+        stats = self.stats()
+        if stats is not None:
+            functions = sorted(stats.stats.items(), key=lambda item: item[1][2], reverse=True)
+            for (filename, line, function), (primitive, calls, own, cumulative, callers) in functions[:limit]:
+                lines.append('{}:{}({}) {} calls, {:.1f}ms own, {:.1f}ms cumulative'.format(
+                    os.path.basename(filename), line, function, calls, own * 1000.0, cumulative * 1000.0))
+        return lines
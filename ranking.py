@@ -1,5 +1,7 @@
-import requests
-import re, json
+import re, json, os
+import time
+import threading
+import Queue
 
 game_to_filename = {
     '3ds': 'ssb3ds.json',
@@ -18,6 +20,25 @@ game_to_filename = {
     1106: 'ssf2.json'
 }
 
+# these caches are kept across reload() so that !refresh does not empty them
+try:
+    tournament_cache
+except NameError:
+    # url -> (time fetched, payload) of the tournaments fetched for !prepare
+    tournament_cache = {}
+
+try:
+    database_cache
+except NameError:
+    # filename -> (mtime, RankingDatabase) of the Hypest database files
+    database_cache = {}
+
+try:
+    scores_lock
+except NameError:
+    # held by add_scores while it reads and rewrites a seasonal ranking file
+    scores_lock = threading.Lock()
+
 """An exception thrown when challonge reports an error"""
 class ChallongeAPIError(Exception):
     pass
@@ -26,6 +47,29 @@ class ChallongeAPIError(Exception):
 class RankingError(Exception):
     pass
 
+"""A Hypest database file with the lookups !rank needs precomputed
+
+The file is a challonge_username:entry mapping where every entry has
+rating, wins, losses, ties and challonge_username keys."""
+class RankingDatabase(object):
+    def __init__(self, entries):
+        self.entries = entries
+        self.by_name = dict((k.lower(), v) for k, v in entries.iteritems())
+        ranking = sorted(entries.values(), key=lambda e: e.get('rating', 0), reverse=True)
+        self.size = len(ranking)
+        # challonge_username -> 0-based place in the ranking
+        self.places = {}
+        for index, entry in enumerate(ranking):
+            self.places.setdefault(entry.get('challonge_username'), index)
+
+    def lookup(self, name):
+        """Returns the entry for the (case insensitive) name or None"""
+        return self.by_name.get(name.lower(), None)
+
+# the databases cached before a reload() use the new class, snapshot.py can't pickle the old one
+for _, database in database_cache.itervalues():
+    database.__class__ = RankingDatabase
+
 """An object that represents a player"""
 class Player(object):
     def __init__(self, id):
@@ -43,6 +87,7 @@ class Match(object):
         self.player1_id = match_json['player1_id']
         self.player2_id = match_json['player2_id']
         self.winner_id  = match_json['winner_id']
+        self.completed_at = match_json.get('completed_at')
 
 """An object that represents the challonge API"""
 class Challonge(object):
@@ -66,21 +111,56 @@ class Challonge(object):
         challonge_username = participant.get('challonge_username')
         return challonge_username if challonge_username else participant.get('display_name')
 
-    def show_tournament(self, url):
-        """Returns a tournament with matches and participants"""
+    def show_tournament(self, url, include_matches=True):
+        """Returns a tournament with participants (and matches unless include_matches is False)"""
+        import requests
         params = {
             'api_key': self.api_key,
-            'include_matches': '1',
+            'include_matches': '1' if include_matches else '0',
             'include_participants': '1'
         }
 
         new_url = Challonge.prepare_url(url)
         r = requests.get('{}/tournaments/{}.json'.format(Challonge.API_BASE_URL, new_url), params=params)
         if r.status_code != 200:
-            raise ChallongeAPIError("unable to retrieve challonge tournament (url: {})".format(url))
+            raise ChallongeAPIError("unable to retrieve challonge tournament (url: {}) [error: {}]".format(url, r.text))
 
         return r.json()['tournament']
 
+    def cached_tournament(self, url, max_age=60):
+        """Returns the tournament with its participants, reusing a payload fetched less than max_age seconds ago
+
+        Payloads older than that are dropped since check ins may have changed them.
+        This is only meant for previews (e.g. !prepare dry), anything that changes
+        the tournament through the API must plan from show_tournament instead."""
+        now = time.time()
+        for key, (fetched, _) in tournament_cache.items():
+            if now - fetched > max_age:
+                tournament_cache.pop(key, None)
+
+        cached = tournament_cache.get(url)
+        if cached is not None:
+            return cached[1]
+        tournament = self.show_tournament(url, include_matches=False)
+        tournament_cache[url] = (now, tournament)
+        return tournament
+
+    def list_tournaments(self, subdomain, state='ended', created_after=None):
+        """Returns the full URLs of the tournaments hosted under a subdomain"""
+        import requests
+        params = {
+            'api_key': self.api_key,
+            'subdomain': subdomain,
+            'state': state
+        }
+        if created_after:
+            params['created_after'] = created_after
+
+        r = requests.get('{}/tournaments.json'.format(Challonge.API_BASE_URL), params=params)
+        if r.status_code != 200:
+            raise ChallongeAPIError("unable to list challonge tournaments (subdomain: {})".format(subdomain))
+
+        return [obj['tournament']['full_challonge_url'] for obj in r.json()]
 
 def get_player_standings(tournament):
     """Returns a list of Player objects with overall tournament statistics and placings"""
@@ -112,6 +192,24 @@ def get_player_standings(tournament):
 
     return cache.values()
 
+def get_match_results(tournament):
+    """Returns a list of (player one, player two, winner, completed_at) tuples of display names
+
+       The winner is None for ties. Matches without two players (e.g. byes) are skipped."""
+    names = {}
+    for obj in tournament['participants']:
+        participant = obj['participant']
+        names[participant['id']] = Challonge.get_display_name(participant)
+
+    results = []
+    for obj in tournament['matches']:
+        match = Match(obj['match'])
+        if match.player1_id is None or match.player2_id is None:
+            continue
+        winner = names.get(match.winner_id) if match.winner_id is not None else None
+        results.append((names.get(match.player1_id), names.get(match.player2_id), winner, match.completed_at))
+    return results
+
 def get_ranking_filename(game_id):
     filename = game_to_filename.get(game_id, None)
     if filename is None:
@@ -131,13 +229,45 @@ def get_rankings(filename):
     except Exception as e:
         raise e
 
-def update_rankings(url, api_key):
-    """Updates the seasonal rankings for the current game
+def load_database(filename):
+    """Returns the RankingDatabase for a Hypest database file
+
+       The parsed file is cached until its modification time changes."""
+    mtime = os.path.getmtime(filename)
+    cached = database_cache.get(filename)
+    if cached is not None and cached[0] == mtime:
+        return cached[1]
+
+    with open(filename, 'r') as f:
+        database = RankingDatabase(json.loads(f.read().decode('utf-8-sig')))
+    database_cache[filename] = (mtime, database)
+    return database
+
+def score_players(players):
+    """Returns a display_name:points mapping for the given players
        The current score values are as follows:
        Round Win - 3 points
        Round Loss - 0 points
        Round Tie - 1 point
        This might be changed in the future"""
+    scores = {}
+    for player in players:
+        # players sharing a display name share a ranking entry
+        scores[player.name] = scores.get(player.name, 0) + 3 * player.wins + 1 * player.ties
+    return scores
+
+def add_scores(filename, scores):
+    """Adds the display_name:points mapping to the seasonal ranking file"""
+    with scores_lock:
+        current_ranking = get_rankings(filename)
+        for name, points in scores.iteritems():
+            current_ranking[name] = current_ranking.get(name, 0) + points
+
+        with open(filename, 'w') as f:
+            json.dump(current_ranking, f, ensure_ascii=True, indent=4)
+
+def update_rankings(url, api_key):
+    """Updates the seasonal rankings for the current game (see score_players for the scoring)"""
 
     challonge = Challonge(api_key)
     tournament = challonge.show_tournament(url)
@@ -146,16 +276,98 @@ def update_rankings(url, api_key):
             json.dump(tournament, f, sort_keys=True, indent=4)
         raise RankingError('The tournament is incomplete')
 
-    game_id = tournament['game_id']
-    filename = get_ranking_filename(game_id)
-    current_ranking = get_rankings(filename)
-    players = get_player_standings(tournament)
+    filename = get_ranking_filename(tournament['game_id'])
+    add_scores(filename, score_players(get_player_standings(tournament)))
 
-    for player in players:
-        ranking = current_ranking.setdefault(player.name, 0)
-        ranking += 3 * player.wins
-        ranking += 1 * player.ties
-        current_ranking[player.name] = ranking
+# the most tournaments fetched at the same time
+max_fetch_workers = 32
+
+def fetch_tournaments(urls, api_key, workers=None):
+    """Fetches the tournaments concurrently, one thread per URL up to workers (default max_fetch_workers)
+
+       Yields (url, tournament, error) tuples in the order the fetches complete,
+       where exactly one of tournament and error is None."""
+    challonge = Challonge(api_key)
+    pending = Queue.Queue()
+    results = Queue.Queue()
+    for url in urls:
+        pending.put(url)
+
+    def worker():
+        while True:
+            try:
+                url = pending.get_nowait()
+            except Queue.Empty:
+                return
+            try:
+                results.put((url, challonge.show_tournament(url), None))
+            except Exception as e:
+                results.put((url, None, e))
+
+    for _ in range(min(workers or max_fetch_workers, len(urls))):
+        thread = threading.Thread(target=worker)
+        thread.daemon = True
+        thread.start()
+
+    for _ in range(len(urls)):
+        yield results.get()
+
+def update_rankings_many(urls, api_key, callback=None, workers=None, on_tournament=None):
+    """Updates the seasonal rankings with many tournaments at once
+
+       The work is pipelined: the tournaments are fetched concurrently, the
+       standings of each one are computed as soon as its fetch completes and
+       the ranking files are written once at the end, one write per game.
+       Up to max_fetch_workers tournaments are fetched at once, so a batch of
+       at most that many takes roughly as long as the slowest fetch.
+       URLs naming the same tournament (see Challonge.prepare_url) are only ranked once.
+
+       callback(url, success, status) is called as each tournament completes and
+       on_tournament(tournament) with every complete tournament payload.
+       Returns the list of (url, success, status) tuples in completion order."""
+    seen = set()
+    unique = []
+    for url in urls:
+        identifier = Challonge.prepare_url(url)
+        if identifier not in seen:
+            seen.add(identifier)
+            unique.append(url)
+    urls = unique
+    return rank_tournaments(fetch_tournaments(urls, api_key, workers), callback, on_tournament)
+
+def rank_tournaments(fetched, callback=None, on_tournament=None):
+    """The compute and write stages of update_rankings_many
+
+       fetched is an iterable of (url, tournament, error) tuples as produced by fetch_tournaments."""
+    # filename -> display_name:points mapping accumulated over the batch
+    scores = {}
+    statuses = []
+    for url, tournament, error in fetched:
+        if error is None and tournament['state'] != 'complete':
+            error = RankingError('The tournament is incomplete')
+
+        if error is None:
+            try:
+                filename = get_ranking_filename(tournament['game_id'])
+            except RankingError as e:
+                error = e
+
+        if error is None:
+            players = get_player_standings(tournament)
+            totals = scores.setdefault(filename, {})
+            for name, points in score_players(players).iteritems():
+                totals[name] = totals.get(name, 0) + points
+            if on_tournament:
+                on_tournament(tournament)
+            status = (url, True, '{} players scored'.format(len(players)))
+        else:
+            status = (url, False, str(error))
+
+        statuses.append(status)
+        if callback:
+            callback(*status)
+
+    for filename, totals in scores.iteritems():
+        add_scores(filename, totals)
 
-    with open(filename, 'w') as f:
-        json.dump(current_ranking, f, ensure_ascii=True, indent=4)
+    return statuses
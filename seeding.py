@@ -0,0 +1,102 @@
+import bisect
+from collections import namedtuple
+
+"""A checked in participant with its rating and its current seed on challonge"""
+Entrant = namedtuple('Entrant', ['name', 'id', 'rating', 'seed'])
+
+"""The minimal set of challonge writes needed to reach a target seeding
+
+removals is a list of banned entrants to delete, moves is a list of
+(entrant, seed) tuples to apply in order after the removals. Challonge shifts
+the other seeds when a participant is deleted or given a new seed, the moves
+take that into account."""
+class SeedingPlan(object):
+    def __init__(self, target, removals, moves, unchanged):
+        self.target = target
+        self.removals = removals
+        self.moves = moves
+        self.unchanged = unchanged
+
+    def api_calls(self):
+        return len(self.removals) + len(self.moves)
+
+    def describe(self, limit=20):
+        """Returns a list of human readable lines for the plan (at most limit steps)"""
+        steps = ['remove {} (banned)'.format(entrant.name) for entrant in self.removals]
+        steps.extend('move {} from seed {} to seed {}'.format(entrant.name, entrant.seed, seed) for entrant, seed in self.moves)
+        if len(steps) > limit:
+            steps = steps[:limit] + ['... and {} more'.format(len(steps) - limit)]
+        return steps
+
+def get_entrants(tournament, db):
+    """Returns the list of checked in entrants of a tournament payload
+
+       db is the Hypest database mapping challonge usernames to their entries.
+       Unranked entrants get a rating of 0."""
+    entrants = []
+    for obj in tournament['participants']:
+        participant = obj['participant']
+        if participant.get('checked_in', False):
+            name = participant['challonge_username']
+            entry = db.get(name, None)
+            rating = entry['rating'] if entry is not None else 0
+            entrants.append(Entrant(name=name, id=participant['id'], rating=rating, seed=participant.get('seed')))
+    return entrants
+
+def target_order(entrants, banned):
+    """Returns the entrants that are not banned sorted by rating
+
+       Ties keep their current relative seeding so they need no moves."""
+    remaining = [entrant for entrant in entrants if entrant.name not in banned]
+    return sorted(remaining, key=lambda e: (-e.rating, e.seed if e.seed is not None else float('inf')))
+
+def longest_increasing(values):
+    """Returns the indices of one longest strictly increasing subsequence of values"""
+    tails = []
+    tail_indices = []
+    previous = [-1] * len(values)
+    for index, value in enumerate(values):
+        position = bisect.bisect_left(tails, value)
+        if position > 0:
+            previous[index] = tail_indices[position - 1]
+        if position == len(tails):
+            tails.append(value)
+            tail_indices.append(index)
+        else:
+            tails[position] = value
+            tail_indices[position] = index
+
+    result = []
+    index = tail_indices[-1] if tail_indices else -1
+    while index != -1:
+        result.append(index)
+        index = previous[index]
+    result.reverse()
+    return result
+
+def plan(entrants, banned):
+    """Computes the SeedingPlan that turns the current seeding into the target seeding
+
+       Every entrant that is part of a longest run already in the right relative
+       order stays put, the rest are moved right after their target predecessor.
+       This is the minimal number of seed changes."""
+    banned = set(banned)
+    removals = [entrant for entrant in entrants if entrant.name in banned]
+    target = target_order(entrants, banned)
+
+    # the current seeding once the banned entrants are removed, challonge already
+    # dropped the participants that did not check in when check ins were processed
+    order = sorted(target, key=lambda e: e.seed if e.seed is not None else float('inf'))
+    rank = dict((entrant.id, index) for index, entrant in enumerate(target))
+    keep = set(order[index].id for index in longest_increasing([rank[entrant.id] for entrant in order]))
+
+    moves = []
+    for index, entrant in enumerate(target):
+        if entrant.id in keep:
+            continue
+        order.remove(entrant)
+        position = order.index(target[index - 1]) + 1 if index > 0 else 0
+        order.insert(position, entrant)
+        moves.append((entrant, position + 1))
+
+    return SeedingPlan(target, removals, moves, len(keep))
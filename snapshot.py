@@ -0,0 +1,121 @@
+import cPickle
+import os
+import threading
+import time
+
+import commands
+import headtohead
+import ranking
+import log
+
+"""Snapshots of the bot caches for warm restarts
+
+A snapshot holds the parsed Hypest databases, the parsed ban list, the
+head-to-head index and the pending !timer notifications. It is written
+periodically (and on exit) to a single pickle file and read back on startup
+so that a restarted bot answers from warm caches right away.
+
+Cached files are only restored if the source file still has the
+modification time recorded in the snapshot, anything else is dropped and
+loaded lazily again."""
+
+logger = log.get_logger('snapshot')
+
+# bumped whenever the layout of the snapshot changes
+version = 3
+
+def collect():
+    """Returns the state to snapshot"""
+    return {
+        'version': version,
+        'created': time.time(),
+        'databases': dict(ranking.database_cache),
+        'bans': dict(commands.ban_cache),
+        'h2h': dict(headtohead.index_cache),
+        'timers': list(commands.pending_timers),
+    }
+
+def save(filename):
+    """Writes a snapshot atomically (to a temporary file that is then renamed)"""
+    start = time.time()
+    state = collect()
+    temporary = filename + '.tmp'
+    with open(temporary, 'wb') as f:
+        cPickle.dump(state, f, cPickle.HIGHEST_PROTOCOL)
+    os.rename(temporary, filename)
+    logger.info('snapshot saved', extra={'latency_ms': (time.time() - start) * 1000.0})
+
+def load(filename):
+    """Returns the snapshot state or None if there is no usable snapshot"""
+    if not os.path.exists(filename):
+        return None
+    try:
+        with open(filename, 'rb') as f:
+            state = cPickle.load(f)
+    except Exception:
+        logger.exception('unable to read snapshot %s', filename)
+        return None
+    if not isinstance(state, dict) or state.get('version') != version:
+        logger.warning('ignoring snapshot %s from another version', filename)
+        return None
+    return state
+
+def fresh(cache):
+    """Returns the entries of a filename -> (mtime, value) cache whose file is unchanged"""
+    result = {}
+    for filename, (mtime, value) in cache.iteritems():
+        try:
+            if os.path.getmtime(filename) == mtime:
+                result[filename] = (mtime, value)
+        except OSError:
+            pass
+    return result
+
+def restore(bot, filename):
+    """Fills the caches from the snapshot and arms the pending timers again once the bot joined its channels
+
+       Returns True if a snapshot was restored."""
+    start = time.time()
+    state = load(filename)
+    if state is None:
+        return False
+
+    ranking.database_cache.update(fresh(state['databases']))
+    commands.ban_cache.update(fresh(state['bans']))
+    headtohead.index_cache.update(fresh(state['h2h']))
+    def arm_timers():
+        for deadline, channel, user in state['timers']:
+            # timers that expired while the bot was down fire right away
+            commands.schedule_timer(bot, deadline, channel, user)
+    bot.after_join.append(arm_timers)
+
+    logger.info('snapshot restored', extra={'latency_ms': (time.time() - start) * 1000.0})
+    return True
+
+"""Saves a snapshot every interval seconds on a background thread"""
+class Snapshotter(threading.Thread):
+    def __init__(self, filename, interval=300):
+        threading.Thread.__init__(self, name='snapshotter')
+        self.daemon = True
+        self.filename = filename
+        self.interval = interval
+        self.stopped = threading.Event()
+
+    def run(self):
+        while not self.stopped.wait(self.interval):
+            try:
+                save(self.filename)
+            except Exception:
+                logger.exception('unable to save snapshot')
+
+    def stop(self):
+        """Stops the thread and writes a final snapshot"""
+        self.stopped.set()
+        # a periodic save still running would write the same temporary file
+        if self.is_alive():
+            self.join()
+        try:
+            save(self.filename)
+        except Exception:
+            # never keep the rest of the shutdown (e.g. flushing the logs) from running
+            logger.exception('unable to save the final snapshot')
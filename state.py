@@ -0,0 +1,285 @@
+import string
+
+"""Channel membership and user state tracking
+
+The tracker is fed every message the bot receives (JOIN, PART, KICK, QUIT,
+NICK, MODE, ACCOUNT and the NAMES/ISUPPORT numerics) and keeps:
+
+- per channel, a nick -> mode bits mapping (op, voice, ...)
+- per user, the set of channels they share with the bot and their account
+
+All lookups are dictionary lookups keyed by the case-folded name so they
+take constant time, and a nick change only renames the entries of the
+channels that user is in."""
+
+rfc1459_table = string.maketrans(string.ascii_uppercase + '[]\\~', string.ascii_lowercase + '{}|^')
+ascii_table = string.maketrans(string.ascii_uppercase, string.ascii_lowercase)
+
+def arguments(message):
+    """Returns all the parameters of a message including the trailing one"""
+    result = (message.parameters or '').split()
+    if message.text is not None:
+        result.append(message.text)
+    return result
+
+"""A user seen in at least one of the bot's channels"""
+class User(object):
+    __slots__ = ('nick', 'account', 'channels')
+
+    def __init__(self, nick):
+        self.nick = nick
+        self.account = None
+        # case-folded names of the channels shared with the bot
+        self.channels = set()
+
+"""A channel the bot is in"""
+class Channel(object):
+    __slots__ = ('name', 'members')
+
+    def __init__(self, name):
+        self.name = name
+        # case-folded nick -> bit set of prefix modes (see StateTracker.mode_bits)
+        self.members = {}
+
+class StateTracker(object):
+    def __init__(self, nickname):
+        self.nickname = nickname
+        self.users = {}
+        self.channels = {}
+        self.table = rfc1459_table
+        self.set_prefixes('(ov)@+')
+        # the CHANMODES types: list modes and modes that always take a parameter
+        # and the ones that only take one when set
+        self.parameter_modes = set('beIk')
+        self.set_parameter_modes = set('l')
+        self.handlers = {
+            'JOIN': self.on_join,
+            'PART': self.on_part,
+            'KICK': self.on_kick,
+            'QUIT': self.on_quit,
+            'NICK': self.on_nick,
+            'MODE': self.on_mode,
+            'ACCOUNT': self.on_account,
+            '005': self.on_isupport,
+            '353': self.on_names,
+        }
+
+    def fold(self, name):
+        if isinstance(name, unicode):
+            # e.g. the nickname from config.json, the tables only map bytes
+            name = name.encode('utf-8')
+        return name.translate(self.table)
+
+    def set_prefixes(self, value):
+        # e.g. (qaohv)~&@%+
+        modes, _, symbols = value[1:].partition(')')
+        self.mode_bits = dict((mode, 1 << index) for index, mode in enumerate(modes))
+        self.symbol_bits = dict((symbol, 1 << index) for index, symbol in enumerate(symbols))
+
+    def feed(self, message):
+        """Updates the state from a received Message"""
+        handler = self.handlers.get(message.command)
+        if handler is not None:
+            handler(message)
+        elif message.account is not None and message.nick is not None:
+            # the account-tag on any message keeps the account up to date
+            user = self.users.get(self.fold(message.nick))
+            if user is not None:
+                user.account = message.account
+
+    # queries
+
+    def user(self, nick):
+        return self.users.get(self.fold(nick))
+
+    def account(self, nick):
+        user = self.users.get(self.fold(nick))
+        return user.account if user is not None else None
+
+    def is_member(self, channel, nick):
+        channel = self.channels.get(self.fold(channel))
+        return channel is not None and self.fold(nick) in channel.members
+
+    def has_mode(self, channel, nick, mode):
+        channel = self.channels.get(self.fold(channel))
+        if channel is None:
+            return False
+        return bool(channel.members.get(self.fold(nick), 0) & self.mode_bits.get(mode, 0))
+
+    def is_op(self, channel, nick):
+        return self.has_mode(channel, nick, 'o')
+
+    def is_voiced(self, channel, nick):
+        return self.has_mode(channel, nick, 'v')
+
+    def members(self, channel):
+        """Returns the nicks currently in the channel"""
+        channel = self.channels.get(self.fold(channel))
+        if channel is None:
+            return []
+        return [self.users[key].nick for key in channel.members]
+
+    def channels_of(self, nick):
+        """Returns the names of the channels the nick shares with the bot"""
+        user = self.users.get(self.fold(nick))
+        if user is None:
+            return []
+        return [self.channels[key].name for key in user.channels]
+
+    # bookkeeping
+
+    def _add(self, channel_name, nick, modes=0):
+        channel = self.channels.get(self.fold(channel_name))
+        if channel is None:
+            return
+        key = intern(self.fold(nick))
+        user = self.users.get(key)
+        if user is None:
+            user = self.users[key] = User(intern(nick))
+        user.channels.add(self.fold(channel_name))
+        channel.members[key] = channel.members.get(key, 0) | modes
+        return user
+
+    def _remove(self, channel_key, key):
+        channel = self.channels.get(channel_key)
+        if channel is not None:
+            channel.members.pop(key, None)
+        user = self.users.get(key)
+        if user is not None:
+            user.channels.discard(channel_key)
+            if not user.channels:
+                del self.users[key]
+
+    def _leave(self, channel_key):
+        channel = self.channels.pop(channel_key, None)
+        if channel is None:
+            return
+        for key in channel.members:
+            user = self.users.get(key)
+            if user is not None:
+                user.channels.discard(channel_key)
+                if not user.channels:
+                    del self.users[key]
+
+    # handlers
+
+    def on_join(self, message):
+        params = arguments(message)
+        if not params:
+            return
+        channel_name = params[0]
+        if self.fold(message.nick) == self.fold(self.nickname):
+            self.channels.setdefault(self.fold(channel_name), Channel(channel_name))
+        user = self._add(channel_name, message.nick)
+        if user is not None and len(params) >= 2:
+            # extended-join gives the account, * when logged out
+            user.account = params[1] if params[1] != '*' else None
+
+    def on_part(self, message):
+        params = arguments(message)
+        if not params:
+            return
+        for channel_name in params[0].split(','):
+            if self.fold(message.nick) == self.fold(self.nickname):
+                self._leave(self.fold(channel_name))
+            else:
+                self._remove(self.fold(channel_name), self.fold(message.nick))
+
+    def on_kick(self, message):
+        params = arguments(message)
+        if len(params) < 2:
+            return
+        if self.fold(params[1]) == self.fold(self.nickname):
+            self._leave(self.fold(params[0]))
+        else:
+            self._remove(self.fold(params[0]), self.fold(params[1]))
+
+    def on_quit(self, message):
+        key = self.fold(message.nick)
+        user = self.users.pop(key, None)
+        if user is None:
+            return
+        for channel_key in user.channels:
+            channel = self.channels.get(channel_key)
+            if channel is not None:
+                channel.members.pop(key, None)
+
+    def on_nick(self, message):
+        params = arguments(message)
+        if not params:
+            return
+        new_nick = params[0]
+        old_key = self.fold(message.nick)
+        new_key = intern(self.fold(new_nick))
+        if old_key == self.fold(self.nickname):
+            self.nickname = new_nick
+        user = self.users.pop(old_key, None)
+        if user is None:
+            return
+        user.nick = intern(new_nick)
+        self.users[new_key] = user
+        for channel_key in user.channels:
+            members = self.channels[channel_key].members
+            members[new_key] = members.pop(old_key, 0)
+
+    def on_mode(self, message):
+        params = arguments(message)
+        if len(params) < 2:
+            return
+        channel = self.channels.get(self.fold(params[0]))
+        if channel is None:
+            # user modes
+            return
+        adding = True
+        index = 2
+        for mode in params[1]:
+            if mode in '+-':
+                adding = mode == '+'
+                continue
+            if mode in self.mode_bits:
+                if index >= len(params):
+                    break
+                key = self.fold(params[index])
+                index += 1
+                if key in channel.members:
+                    if adding:
+                        channel.members[key] |= self.mode_bits[mode]
+                    else:
+                        channel.members[key] &= ~self.mode_bits[mode]
+            elif mode in self.parameter_modes or (adding and mode in self.set_parameter_modes):
+                index += 1
+
+    def on_account(self, message):
+        # account-notify
+        params = arguments(message)
+        user = self.users.get(self.fold(message.nick))
+        if user is not None and params:
+            user.account = params[0] if params[0] != '*' else None
+
+    def on_isupport(self, message):
+        for token in arguments(message)[1:]:
+            name, _, value = token.partition('=')
+            if name == 'PREFIX' and value:
+                self.set_prefixes(value)
+            elif name == 'CASEMAPPING':
+                self.table = ascii_table if value == 'ascii' else rfc1459_table
+            elif name == 'CHANMODES' and value:
+                types = value.split(',') + ['', '', '']
+                self.parameter_modes = set(types[0] + types[1])
+                self.set_parameter_modes = set(types[2])
+
+    def on_names(self, message):
+        # :server 353 bot = #channel :@op +voice nick
+        params = arguments(message)
+        if len(params) < 4:
+            return
+        channel_name = params[2]
+        for entry in params[3].split():
+            modes = 0
+            while entry and entry[0] in self.symbol_bits:
+                modes |= self.symbol_bits[entry[0]]
+                entry = entry[1:]
+            # userhost-in-names
+            nick = entry.split('!', 1)[0]
+            if nick:
+                self._add(channel_name, nick, modes)
@@ -0,0 +1,239 @@
+import datetime as dt
+import random
+
+"""Synthetic Challonge-shaped tournaments for benchmarks and load tests
+
+generate_tournament builds the same JSON structure show_tournament returns
+(with include_matches and include_participants) for single elimination,
+double elimination and round robin brackets. Match outcomes follow the
+seeding with some upsets, ties are only possible in round robin and
+disqualified players forfeit every match they have left.
+
+Round robin brackets are split into pools of at most pool_size players
+like Challonge group stages, otherwise 4096 entrants would need millions
+of matches."""
+
+formats = ('single elimination', 'double elimination', 'round robin')
+
+"""Builds one synthetic tournament, seeded so the same arguments give the same payload"""
+class Generator(object):
+    def __init__(self, entrants, seed=0, tie_rate=0.0, dq_rate=0.0, upset_rate=0.3, pool_size=16):
+        self.random = random.Random(seed)
+        self.entrants = entrants
+        self.tie_rate = tie_rate
+        self.upset_rate = upset_rate
+        self.pool_size = pool_size
+        self.matches = []
+        self.clock = dt.datetime(2016, 1, 1, 18, 0)
+        self.participants = []
+        for index in range(entrants):
+            name = 'player{}'.format(index)
+            self.participants.append({
+                'id': 100000 + index,
+                'seed': index + 1,
+                'name': name,
+                'display_name': name,
+                'challonge_username': name,
+                'checked_in': True,
+                'active': True,
+                'final_rank': None,
+            })
+        self.disqualified = set(p['id'] for p in self.participants if self.random.random() < dq_rate)
+        self.seed_of = dict((p['id'], p['seed']) for p in self.participants)
+
+    def play(self, one, two, round_number, allow_ties=False):
+        """Adds a match and returns (winner, loser), both None for a tie"""
+        self.clock += dt.timedelta(minutes=self.random.randint(1, 10))
+        forfeited = False
+        if one in self.disqualified or two in self.disqualified:
+            forfeited = True
+            if one in self.disqualified and two in self.disqualified:
+                winner = one
+            else:
+                winner = two if one in self.disqualified else one
+        elif allow_ties and self.random.random() < self.tie_rate:
+            winner = None
+        else:
+            favourite, underdog = (one, two) if self.seed_of[one] < self.seed_of[two] else (two, one)
+            winner = underdog if self.random.random() < self.upset_rate else favourite
+
+        loser = None if winner is None else (two if winner == one else one)
+        if forfeited:
+            scores = '-1-0' if winner == one else '0--1'
+        elif winner is None:
+            scores = '1-1'
+        else:
+            scores = '2-{}'.format(self.random.randint(0, 1)) if winner == one else '{}-2'.format(self.random.randint(0, 1))
+
+        self.matches.append({'match': {
+            'id': 500000 + len(self.matches),
+            'state': 'complete',
+            'round': round_number,
+            'player1_id': one,
+            'player2_id': two,
+            'winner_id': winner,
+            'loser_id': loser,
+            'scores_csv': scores,
+            'forfeited': forfeited,
+            'completed_at': self.clock.isoformat(),
+        }})
+        return winner, loser
+
+    def elimination_round(self, players, round_number):
+        """Plays a round where None is a bye, returns (winners, losers)"""
+        winners, losers = [], []
+        for index in range(0, len(players), 2):
+            one, two = players[index], players[index + 1]
+            if one is None or two is None:
+                winners.append(two if one is None else one)
+                continue
+            winner, loser = self.play(one, two, round_number)
+            winners.append(winner)
+            losers.append(loser)
+        return winners, losers
+
+    def bracket_order(self):
+        """Returns the participant ids in standard bracket order padded with byes to a power of two"""
+        size = 1
+        while size < self.entrants:
+            size *= 2
+        order = [1]
+        while len(order) < size:
+            total = len(order) * 2 + 1
+            order = [seed for pair in ((s, total - s) for s in order) for seed in pair]
+        ids = dict((p['seed'], p['id']) for p in self.participants)
+        return [ids.get(seed) for seed in order]
+
+    def single_elimination(self):
+        players = self.bracket_order()
+        placements = []
+        round_number = 1
+        while len(players) > 1:
+            players, losers = self.elimination_round(players, round_number)
+            placements.append(losers)
+            round_number += 1
+        placements.append(players)
+        return placements
+
+    def double_elimination(self):
+        players = self.bracket_order()
+        losers_bracket = []
+        placements = []
+        round_number = 1
+        while len(players) > 1:
+            players, dropped = self.elimination_round(players, round_number)
+            # losers bracket rounds are numbered negatively like challonge does
+            losers_bracket.extend(dropped)
+            self.random.shuffle(losers_bracket)
+            if len(losers_bracket) % 2 == 1:
+                losers_bracket.append(None)
+            losers_bracket, eliminated = self.elimination_round(losers_bracket, -round_number)
+            losers_bracket = [player for player in losers_bracket if player is not None]
+            placements.append(eliminated)
+            round_number += 1
+
+        while len(losers_bracket) > 1:
+            if len(losers_bracket) % 2 == 1:
+                losers_bracket.append(None)
+            losers_bracket, eliminated = self.elimination_round(losers_bracket, -round_number)
+            placements.append(eliminated)
+            round_number += 1
+
+        if losers_bracket:
+            winner, loser = self.play(players[0], losers_bracket[0], round_number)
+            placements.append([loser])
+            players = [winner]
+        placements.append(players)
+        return placements
+
+    def round_robin(self):
+        ids = [p['id'] for p in self.participants]
+        self.random.shuffle(ids)
+        points = dict((player, 0) for player in ids)
+        for start in range(0, len(ids), self.pool_size):
+            pool = ids[start:start + self.pool_size]
+            for i in range(len(pool)):
+                for j in range(i + 1, len(pool)):
+                    winner, loser = self.play(pool[i], pool[j], j - i, allow_ties=True)
+                    if winner is None:
+                        points[pool[i]] += 1
+                        points[pool[j]] += 1
+                    else:
+                        points[winner] += 3
+        ranked = sorted(ids, key=lambda player: points[player])
+        return [[player] for player in ranked]
+
+    def generate(self, format, state='complete', game_id=16869, name=None):
+        if format not in formats:
+            raise ValueError('unknown tournament format: {}'.format(format))
+        placements = getattr(self, format.replace(' ', '_'))()
+
+        # placements go from first eliminated to the winner
+        rank = 1
+        for group in reversed(placements):
+            group = [player for player in group if player is not None]
+            for player in group:
+                self.participants[self.seed_of[player] - 1]['final_rank'] = rank
+            rank += len(group)
+        for participant in self.participants:
+            if participant['id'] in self.disqualified:
+                participant['active'] = False
+
+        return {
+            'id': self.random.randint(1, 10 ** 7),
+            'name': name or 'Synthetic {} ({} entrants)'.format(format, self.entrants),
+            'url': 'synthetic{}'.format(self.entrants),
+            'tournament_type': format,
+            'state': state,
+            'game_id': game_id,
+            'participants_count': self.entrants,
+            'participants': [{'participant': participant} for participant in self.participants],
+            'matches': self.matches,
+        }
+
+def generate_tournament(entrants, format='double elimination', seed=0, **kwargs):
+    """Returns a complete synthetic tournament payload (see Generator for the options)"""
+    state = kwargs.pop('state', 'complete')
+    return Generator(entrants, seed=seed, **kwargs).generate(format, state=state)
+
+def generate_database(entrants, seed=0, ranked=0.8):
+    """Returns a Hypest database with an entry for roughly ranked of the synthetic players"""
+    rng = random.Random(seed)
+    database = {}
+    for index in range(entrants):
+        if rng.random() >= ranked:
+            continue
+        name = 'player{}'.format(index)
+        wins, losses, ties = rng.randint(0, 60), rng.randint(0, 60), rng.randint(0, 5)
+        database[name] = {
+            'challonge_username': name,
+            'rating': round(rng.gauss(1500, 200), 2),
+            'wins': wins,
+            'losses': losses,
+            'ties': ties,
+        }
+    return database
+
+def checked_in(tournament, database, seed=0, late=0, shuffle=False):
+    """Turns a payload into a checked in one seeded by the database ratings
+
+       The matches are dropped and `late` random participants are moved to the
+       bottom as if they checked in after seeding, with shuffle the seeding is
+       random instead (the worst case for the seeding planner)."""
+    rng = random.Random(seed)
+    participants = [dict(obj['participant']) for obj in tournament['participants']]
+    if shuffle:
+        rng.shuffle(participants)
+    else:
+        participants.sort(key=lambda p: -database.get(p['challonge_username'], {}).get('rating', 0))
+        late_ids = set(p['id'] for p in rng.sample(participants, min(late, len(participants))))
+        participants = [p for p in participants if p['id'] not in late_ids] + [p for p in participants if p['id'] in late_ids]
+    for index, participant in enumerate(participants):
+        participant['seed'] = index + 1
+        participant['checked_in'] = True
+        participant['final_rank'] = None
+    result = dict(tournament)
+    result['state'] = 'checked_in'
+    result['participants'] = [{'participant': participant} for participant in participants]
+    result['matches'] = []
+    return result